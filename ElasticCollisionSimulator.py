@@ -1,11 +1,23 @@
 import numpy as np
 import os
+import sys
 import shutil
 from PIL import Image
-from multiprocessing import Pool, cpu_count
+from multiprocessing import cpu_count, get_context, shared_memory
 import imageio
 import random
+import json
+import io
+import tracemalloc
+import pickle
+import time
+import copy
+import queue
+import threading
+from collections import deque
+from contextlib import contextmanager
 from tqdm import tqdm
+import argparse
 
 class Ray:
     def __init__(self, origin, direction):
@@ -122,12 +134,653 @@ def trace_ray(ray, objects, lights, depth, max_depth):
 
     return hit_color
 
-def render_chunk(y_start, y_end, scene, width, height, fov, max_depth, samples_per_pixel):
+PACKET_SIZE = 16384
+SHADOW_CACHE_SIZE = 8
+BVH_MIN_SPHERES = 64
+
+class PackedScene:
+    def __init__(self, objects, lights, use_bvh=None, backend='numpy'):
+        self.backend = backend
+        count = len(objects)
+        self.is_sphere = np.array([isinstance(obj, Sphere) for obj in objects], dtype=bool)
+        self.centers = np.zeros((count, 3))
+        self.radii = np.zeros(count)
+        self.normals = np.zeros((count, 3))
+        self.offsets = np.zeros(count)
+        self.colors = np.zeros((count, 3))
+        self.reflectiveness = np.zeros(count)
+
+        for i, obj in enumerate(objects):
+            self.colors[i] = np.asarray(obj.color, dtype=np.float64)
+            if self.is_sphere[i]:
+                self.centers[i] = obj.center
+                self.radii[i] = obj.radius
+                self.reflectiveness[i] = obj.reflectiveness
+            else:
+                self.normals[i] = np.asarray(obj.normal, dtype=np.float64)
+                self.offsets[i] = obj.d
+
+        self.sphere_ids = np.flatnonzero(self.is_sphere)
+        self.wall_ids = np.flatnonzero(~self.is_sphere)
+        self.light_positions = np.array([light.position for light in lights], dtype=np.float64).reshape(-1, 3)
+        self.light_intensities = np.array([light.intensity for light in lights], dtype=np.float64)
+
+        wall_normals = self.normals[self.wall_ids]
+        self.light_wall_sides = self.light_positions @ wall_normals.T + self.offsets[self.wall_ids]
+        self.shadow_cache = [[] for _ in lights]
+
+        self.spheres = [obj for obj in objects if isinstance(obj, Sphere)]
+        if use_bvh is None:
+            use_bvh = len(self.spheres) >= BVH_MIN_SPHERES
+        self.bvh = SphereBVH(self.centers[self.sphere_ids], self.radii[self.sphere_ids]) if use_bvh else None
+
+    def __len__(self):
+        return len(self.is_sphere)
+
+    def update(self):
+        if not self.spheres:
+            return
+        self.centers[self.sphere_ids] = np.array([sphere.center for sphere in self.spheres], dtype=np.float64)
+        self.colors[self.sphere_ids] = np.array([sphere.color for sphere in self.spheres], dtype=np.float64)
+        if self.bvh is not None:
+            self.bvh.refit(self.centers[self.sphere_ids], self.radii[self.sphere_ids])
+
+    def intersect(self, origins, directions):
+        t = np.full((len(origins), len(self)), np.inf)
+        if len(self.sphere_ids):
+            t[:, self.sphere_ids] = intersect_spheres(origins, directions, self.centers[self.sphere_ids], self.radii[self.sphere_ids])
+        if len(self.wall_ids):
+            t[:, self.wall_ids] = intersect_walls(origins, directions, self.normals[self.wall_ids], self.offsets[self.wall_ids])
+        return t
+
+    def nearest(self, origins, directions):
+        if self.bvh is None:
+            t = self.intersect(origins, directions)
+            nearest_object = np.argmin(t, axis=1)
+            nearest_t = t[np.arange(len(t)), nearest_object]
+            return nearest_t, nearest_object
+
+        nearest_t, nearest_sphere = self.bvh.nearest(origins, directions)
+        nearest_object = self.sphere_ids[np.maximum(nearest_sphere, 0)]
+        if len(self.wall_ids):
+            t = intersect_walls(origins, directions, self.normals[self.wall_ids], self.offsets[self.wall_ids])
+            nearest_wall = np.argmin(t, axis=1)
+            wall_t = t[np.arange(len(t)), nearest_wall]
+            closer = wall_t < nearest_t
+            nearest_t = np.where(closer, wall_t, nearest_t)
+            nearest_object = np.where(closer, self.wall_ids[nearest_wall], nearest_object)
+        return nearest_t, nearest_object
+
+    def occluded(self, origins, directions):
+        if self.bvh is None:
+            t = self.intersect(origins, directions)
+            return np.any(np.isfinite(t) & (t > 0), axis=1)
+
+        blocked = self.bvh.occluded(origins, directions)
+        if len(self.wall_ids):
+            t = intersect_walls(origins, directions, self.normals[self.wall_ids], self.offsets[self.wall_ids])
+            blocked |= np.any(np.isfinite(t) & (t > 0), axis=1)
+        return blocked
+
+    def walls_block(self, light, origins, directions):
+        if not len(self.wall_ids):
+            return np.zeros(len(origins), dtype=bool)
+        point_sides = origins @ self.normals[self.wall_ids].T + self.offsets[self.wall_ids]
+        light_sides = self.light_wall_sides[light]
+        distances = np.linalg.norm(self.light_positions[light] - origins, axis=1, keepdims=True)
+        towards_wall = np.abs(light_sides - point_sides) > 1e-6 * distances
+        crosses = ((point_sides > 0) & (light_sides < point_sides)) | ((point_sides < 0) & (light_sides > point_sides))
+        return np.any(towards_wall & crosses, axis=1)
+
+    def sphere_occluders(self, origins, directions):
+        if not len(self.sphere_ids):
+            return np.full(len(origins), -1, dtype=np.int64)
+        if self.bvh is not None:
+            occluder = self.bvh.occluded_by(origins, directions)
+        else:
+            t = intersect_spheres(origins, directions, self.centers[self.sphere_ids], self.radii[self.sphere_ids])
+            blocked = np.isfinite(t)
+            occluder = np.where(blocked.any(axis=1), np.argmax(blocked, axis=1), -1)
+        return np.where(occluder >= 0, self.sphere_ids[np.maximum(occluder, 0)], -1)
+
+    def lit(self, light, origins, directions, candidates):
+        lit = np.zeros(len(origins), dtype=bool)
+        rays = np.flatnonzero(candidates)
+        rays = rays[~self.walls_block(light, origins[rays], directions[rays])]
+
+        cache = self.shadow_cache[light]
+        if cache and len(rays):
+            t = intersect_spheres(origins[rays], directions[rays], self.centers[cache], self.radii[cache])
+            rays = rays[~np.isfinite(t).any(axis=1)]
+
+        occluders = self.sphere_occluders(origins[rays], directions[rays])
+        lit[rays[occluders < 0]] = True
+
+        found = [occluder for occluder in np.unique(occluders[occluders >= 0]).tolist() if occluder not in cache]
+        self.shadow_cache[light] = (found + cache)[:SHADOW_CACHE_SIZE]
+        return lit
+
+    def normals_at(self, hit_points, object_ids):
+        normals = self.normals[object_ids]
+        spheres = self.is_sphere[object_ids]
+        if np.any(spheres):
+            normals[spheres] = normalize_rows(hit_points[spheres] - self.centers[object_ids[spheres]])
+        return normals
+
+def normalize_rows(vectors):
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def intersect_spheres(origins, directions, centers, radii):
+    a = np.einsum('ij,ij->i', directions, directions)[:, None]
+    od = np.einsum('ij,ij->i', origins, directions)[:, None]
+    oo = np.einsum('ij,ij->i', origins, origins)[:, None]
+    b = 2.0 * (od - directions @ centers.T)
+    c = oo - 2.0 * (origins @ centers.T) + np.einsum('ij,ij->i', centers, centers) - radii * radii
+    discriminant = b * b - 4 * a * c
+
+    root = np.sqrt(np.maximum(discriminant, 0))
+    t1 = (-b - root) / (2.0 * a)
+    t2 = (-b + root) / (2.0 * a)
+    t = np.where(t1 > 0.001, t1, np.where(t2 > 0.001, t2, np.inf))
+    return np.where(discriminant > 0, t, np.inf)
+
+def intersect_walls(origins, directions, normals, offsets):
+    denom = directions @ normals.T
+    valid = np.abs(denom) > 1e-6
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = -(origins @ normals.T + offsets) / denom
+    return np.where(valid & (t >= 0), t, np.inf)
+
+BVH_LEAF_SIZE = 4
+BVH_REBUILD_RATIO = 2.0
+
+class SphereBVH:
+    def __init__(self, centers, radii, leaf_size=BVH_LEAF_SIZE):
+        self.leaf_size = leaf_size
+        self.build(centers, radii)
+
+    def build(self, centers, radii):
+        self.centers = np.asarray(centers, dtype=np.float64)
+        self.radii = np.asarray(radii, dtype=np.float64)
+        self.order = np.arange(len(self.centers))
+        left, right, start, count, depth = [], [], [], [], []
+
+        def build_node(first, last, level):
+            node = len(left)
+            left.append(-1)
+            right.append(-1)
+            start.append(first)
+            count.append(last - first)
+            depth.append(level)
+            if last - first <= self.leaf_size:
+                return node
+
+            ids = self.order[first:last]
+            extent = np.ptp(self.centers[ids], axis=0)
+            axis = int(np.argmax(extent))
+            middle = (last - first) // 2
+            self.order[first:last] = ids[np.argpartition(self.centers[ids, axis], middle)]
+            left[node] = build_node(first, first + middle, level + 1)
+            right[node] = build_node(first + middle, last, level + 1)
+            return node
+
+        if len(self.centers):
+            build_node(0, len(self.centers), 0)
+
+        self.left = np.array(left, dtype=np.int64)
+        self.right = np.array(right, dtype=np.int64)
+        self.start = np.array(start, dtype=np.int64)
+        self.count = np.array(count, dtype=np.int64)
+        self.depth = np.array(depth, dtype=np.int64)
+        self.leaves = np.flatnonzero(self.left < 0)
+        self.levels = [np.flatnonzero((self.depth == level) & (self.left >= 0))
+                       for level in range(int(self.depth.max(initial=0)), -1, -1)]
+        self.lows = np.zeros((len(left), 3))
+        self.highs = np.zeros((len(left), 3))
+        self.fit()
+        self.build_cost = self.cost()
+
+    def fit(self):
+        if not len(self.leaves):
+            return
+        lows = self.centers[self.order] - self.radii[self.order, None]
+        highs = self.centers[self.order] + self.radii[self.order, None]
+        self.lows[self.leaves] = np.minimum.reduceat(lows, self.start[self.leaves], axis=0)
+        self.highs[self.leaves] = np.maximum.reduceat(highs, self.start[self.leaves], axis=0)
+        for nodes in self.levels:
+            self.lows[nodes] = np.minimum(self.lows[self.left[nodes]], self.lows[self.right[nodes]])
+            self.highs[nodes] = np.maximum(self.highs[self.left[nodes]], self.highs[self.right[nodes]])
+
+    def cost(self):
+        extent = self.highs - self.lows
+        return float(np.sum(extent[:, 0] * extent[:, 1] + extent[:, 1] * extent[:, 2] + extent[:, 2] * extent[:, 0]))
+
+    def refit(self, centers, radii):
+        if len(centers) != len(self.centers):
+            self.build(centers, radii)
+            return
+        self.centers = np.asarray(centers, dtype=np.float64)
+        self.radii = np.asarray(radii, dtype=np.float64)
+        self.fit()
+        if self.cost() > BVH_REBUILD_RATIO * self.build_cost:
+            self.build(self.centers, self.radii)
+
+    def enter_distance(self, node, origins, inverse_directions):
+        t1 = (self.lows[node] - origins) * inverse_directions
+        t2 = (self.highs[node] - origins) * inverse_directions
+        t_near = np.maximum(np.max(np.minimum(t1, t2), axis=1), 0)
+        t_far = np.min(np.maximum(t1, t2), axis=1)
+        return np.where(t_far >= t_near, t_near, np.inf)
+
+    def traverse(self, origins, directions, any_hit):
+        best_t = np.full(len(origins), np.inf)
+        best_id = np.full(len(origins), -1, dtype=np.int64)
+        if not len(self.leaves) or not len(origins):
+            return best_t, best_id
+
+        inverse_directions = 1.0 / np.where(np.abs(directions) < 1e-12, 1e-12, directions)
+        stack = [(0, np.arange(len(origins)))]
+        while stack:
+            node, rays = stack.pop()
+            rays = rays[self.enter_distance(node, origins[rays], inverse_directions[rays]) < best_t[rays]]
+            if not len(rays):
+                continue
+
+            if self.left[node] >= 0:
+                stack.append((self.right[node], rays))
+                stack.append((self.left[node], rays))
+                continue
+
+            ids = self.order[self.start[node]:self.start[node] + self.count[node]]
+            t = intersect_spheres(origins[rays], directions[rays], self.centers[ids], self.radii[ids])
+            nearest = np.argmin(t, axis=1)
+            nearest_t = t[np.arange(len(rays)), nearest]
+            closer = nearest_t < best_t[rays]
+            if any_hit:
+                nearest_t = np.where(np.isfinite(nearest_t), 0.0, np.inf)
+            best_t[rays[closer]] = nearest_t[closer]
+            best_id[rays[closer]] = ids[nearest[closer]]
+
+        return best_t, best_id
+
+    def nearest(self, origins, directions):
+        return self.traverse(origins, directions, any_hit=False)
+
+    def occluded(self, origins, directions):
+        return self.occluded_by(origins, directions) >= 0
+
+    def occluded_by(self, origins, directions):
+        return self.traverse(origins, directions, any_hit=True)[1]
+
+def reflect_rows(vectors, normals):
+    return vectors - 2 * np.einsum('ij,ij->i', vectors, normals)[:, None] * normals
+
+PROFILE = None
+
+@contextmanager
+def profile_stage(name, rays=0):
+    if PROFILE is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        PROFILE['seconds'][name] = PROFILE['seconds'].get(name, 0.0) + time.perf_counter() - start
+        PROFILE['rays'][name] = PROFILE['rays'].get(name, 0) + rays
+
+def shade_hits(hit_points, normals, object_ids, packed):
+    colors = np.zeros((len(hit_points), 3))
+    shadow_origins = hit_points + normals * 1e-5
+
+    for light, (light_position, intensity) in enumerate(zip(packed.light_positions, packed.light_intensities)):
+        light_dirs = normalize_rows(light_position - hit_points)
+        cosines = np.einsum('ij,ij->i', light_dirs, normals)
+        facing = cosines > 0
+        with profile_stage('shadows', int(np.count_nonzero(facing))):
+            lit = packed.lit(light, shadow_origins, light_dirs, facing)
+        light_intensity = np.clip(cosines, 0, 1) * intensity
+        colors[lit] += packed.colors[object_ids[lit]] * light_intensity[lit, None]
+
+    return colors
+
+def trace_rays(origins, directions, packed, max_depth):
+    colors = np.zeros((len(origins), 3))
+    if len(packed) == 0:
+        return colors
+    if packed.backend == 'numba':
+        return trace_rays_numba(origins, directions, packed, max_depth)
+
+    rays = np.arange(len(origins))
+    weights = np.ones(len(origins))
+    directions = normalize_rows(directions)
+
+    for depth in range(max_depth + 1):
+        if len(rays) == 0:
+            break
+
+        with profile_stage('intersection' if depth == 0 else 'reflections', len(rays)):
+            nearest_t, nearest_object = packed.nearest(origins, directions)
+        hit = np.isfinite(nearest_t)
+        rays, weights, nearest_t, nearest_object = rays[hit], weights[hit], nearest_t[hit], nearest_object[hit]
+        origins, directions = origins[hit], directions[hit]
+
+        hit_points = origins + directions * nearest_t[:, None]
+        normals = packed.normals_at(hit_points, nearest_object)
+        hit_colors = shade_hits(hit_points, normals, nearest_object, packed)
+
+        reflectiveness = packed.reflectiveness[nearest_object]
+        bounce = (reflectiveness > 0) & (depth < max_depth)
+        mix = np.where(bounce, 1 - reflectiveness, 1.0)
+        colors[rays] += (weights * mix)[:, None] * hit_colors
+
+        rays = rays[bounce]
+        weights = weights[bounce] * reflectiveness[bounce]
+        origins = hit_points[bounce]
+        directions = normalize_rows(reflect_rows(directions[bounce], normals[bounce]))
+
+    return colors
+
+def camera_rays(camera, x, y, dx, dy):
+    px = (2 * ((x + dx) / camera.width) - 1) * camera.angle * camera.aspect_ratio
+    py = (1 - 2 * ((y + dy) / camera.height)) * camera.angle
+    directions = camera.forward + np.outer(px, camera.right) + np.outer(py, camera.up)
+    origins = np.broadcast_to(camera.position.astype(np.float64), directions.shape)
+    return origins, normalize_rows(directions)
+
+NUMBA_KERNEL = None
+
+def import_numba():
+    # numba.py next to this script would shadow the real package
+    here = os.path.dirname(os.path.abspath(__file__))
+    saved_path = sys.path[:]
+    sys.path[:] = [entry for entry in sys.path if os.path.abspath(entry or os.curdir) != here]
+    try:
+        import numba
+    finally:
+        sys.path[:] = saved_path
+    return numba
+
+prange = range
+
+def hit_sphere(ox, oy, oz, dx, dy, dz, cx, cy, cz, radius):
+    ocx, ocy, ocz = ox - cx, oy - cy, oz - cz
+    a = dx * dx + dy * dy + dz * dz
+    b = 2.0 * (ocx * dx + ocy * dy + ocz * dz)
+    c = ocx * ocx + ocy * ocy + ocz * ocz - radius * radius
+    discriminant = b * b - 4 * a * c
+    if discriminant > 0:
+        root = np.sqrt(discriminant)
+        t1 = (-b - root) / (2.0 * a)
+        if t1 > 0.001:
+            return t1
+        t2 = (-b + root) / (2.0 * a)
+        if t2 > 0.001:
+            return t2
+    return np.inf
+
+def hit_wall(ox, oy, oz, dx, dy, dz, nx, ny, nz, offset):
+    denom = nx * dx + ny * dy + nz * dz
+    if abs(denom) > 1e-6:
+        t = -(nx * ox + ny * oy + nz * oz + offset) / denom
+        if t >= 0:
+            return t
+    return np.inf
+
+def enter_box(ox, oy, oz, dx, dy, dz, low, high):
+    t_near = 0.0
+    t_far = np.inf
+    origin = (ox, oy, oz)
+    direction = (dx, dy, dz)
+    for axis in range(3):
+        d = direction[axis]
+        if abs(d) < 1e-12:
+            d = 1e-12
+        t1 = (low[axis] - origin[axis]) / d
+        t2 = (high[axis] - origin[axis]) / d
+        t_near = max(t_near, min(t1, t2))
+        t_far = min(t_far, max(t1, t2))
+    return t_near if t_far >= t_near else np.inf
+
+def closest_hit(ox, oy, oz, dx, dy, dz, any_hit, is_sphere, centers, radii, normals, offsets,
+                sphere_ids, wall_ids, lows, highs, left, right, start, count, order):
+    best_t = np.inf
+    best_id = -1
+
+    if len(left) == 0:
+        for k in range(len(is_sphere)):
+            if is_sphere[k]:
+                t = hit_sphere(ox, oy, oz, dx, dy, dz, centers[k, 0], centers[k, 1], centers[k, 2], radii[k])
+            else:
+                t = hit_wall(ox, oy, oz, dx, dy, dz, normals[k, 0], normals[k, 1], normals[k, 2], offsets[k])
+            if any_hit and t < np.inf and t > 0:
+                return t, k
+            if t < best_t:
+                best_t = t
+                best_id = k
+        return best_t, best_id
+
+    stack = np.empty(64, dtype=np.int64)
+    stack[0] = 0
+    top = 1
+    while top > 0:
+        top -= 1
+        node = stack[top]
+        if enter_box(ox, oy, oz, dx, dy, dz, lows[node], highs[node]) >= best_t:
+            continue
+        if left[node] >= 0:
+            stack[top] = right[node]
+            stack[top + 1] = left[node]
+            top += 2
+            continue
+        for slot in range(start[node], start[node] + count[node]):
+            k = sphere_ids[order[slot]]
+            t = hit_sphere(ox, oy, oz, dx, dy, dz, centers[k, 0], centers[k, 1], centers[k, 2], radii[k])
+            if any_hit and t < np.inf:
+                return t, k
+            if t < best_t:
+                best_t = t
+                best_id = k
+
+    for k in wall_ids:
+        t = hit_wall(ox, oy, oz, dx, dy, dz, normals[k, 0], normals[k, 1], normals[k, 2], offsets[k])
+        if any_hit and t < np.inf and t > 0:
+            return t, k
+        if t < best_t:
+            best_t = t
+            best_id = k
+    return best_t, best_id
+
+def trace_kernel(origins, directions, max_depth, is_sphere, centers, radii, normals, offsets, colors, reflectiveness,
+                 light_positions, light_intensities, sphere_ids, wall_ids, lows, highs, left, right, start, count, order):
+    image = np.zeros((len(origins), 3))
+    for i in prange(len(origins)):
+        ox, oy, oz = origins[i, 0], origins[i, 1], origins[i, 2]
+        dx, dy, dz = directions[i, 0], directions[i, 1], directions[i, 2]
+        length = np.sqrt(dx * dx + dy * dy + dz * dz)
+        dx, dy, dz = dx / length, dy / length, dz / length
+        weight = 1.0
+
+        for depth in range(max_depth + 1):
+            t, k = closest_hit(ox, oy, oz, dx, dy, dz, False, is_sphere, centers, radii, normals, offsets,
+                               sphere_ids, wall_ids, lows, highs, left, right, start, count, order)
+            if k < 0 or t == np.inf:
+                break
+
+            px, py, pz = ox + dx * t, oy + dy * t, oz + dz * t
+            if is_sphere[k]:
+                nx, ny, nz = px - centers[k, 0], py - centers[k, 1], pz - centers[k, 2]
+                length = np.sqrt(nx * nx + ny * ny + nz * nz)
+                nx, ny, nz = nx / length, ny / length, nz / length
+            else:
+                nx, ny, nz = normals[k, 0], normals[k, 1], normals[k, 2]
+
+            r = g = b = 0.0
+            for light in range(len(light_intensities)):
+                lx = light_positions[light, 0] - px
+                ly = light_positions[light, 1] - py
+                lz = light_positions[light, 2] - pz
+                length = np.sqrt(lx * lx + ly * ly + lz * lz)
+                lx, ly, lz = lx / length, ly / length, lz / length
+                if lx * nx + ly * ny + lz * nz <= 0:
+                    continue
+                _, blocker = closest_hit(px + nx * 1e-5, py + ny * 1e-5, pz + nz * 1e-5, lx, ly, lz, True,
+                                         is_sphere, centers, radii, normals, offsets,
+                                         sphere_ids, wall_ids, lows, highs, left, right, start, count, order)
+                if blocker < 0:
+                    intensity = min(max(lx * nx + ly * ny + lz * nz, 0.0), 1.0) * light_intensities[light]
+                    r += colors[k, 0] * intensity
+                    g += colors[k, 1] * intensity
+                    b += colors[k, 2] * intensity
+
+            bounce = reflectiveness[k] > 0 and depth < max_depth
+            mix = 1 - reflectiveness[k] if bounce else 1.0
+            image[i, 0] += weight * mix * r
+            image[i, 1] += weight * mix * g
+            image[i, 2] += weight * mix * b
+            if not bounce:
+                break
+
+            weight *= reflectiveness[k]
+            dot = dx * nx + dy * ny + dz * nz
+            dx, dy, dz = dx - 2 * dot * nx, dy - 2 * dot * ny, dz - 2 * dot * nz
+            length = np.sqrt(dx * dx + dy * dy + dz * dz)
+            dx, dy, dz = dx / length, dy / length, dz / length
+            ox, oy, oz = px, py, pz
+
+    return image
+
+def compile_numba_kernel():
+    # Module-level kernels let numba cache the machine code on disk, so each pool worker loads it instead of recompiling
+    global hit_sphere, hit_wall, enter_box, closest_hit, prange
+    numba = import_numba()
+    prange = numba.prange
+    hit_sphere = numba.njit(cache=True)(hit_sphere)
+    hit_wall = numba.njit(cache=True)(hit_wall)
+    enter_box = numba.njit(cache=True)(enter_box)
+    closest_hit = numba.njit(cache=True)(closest_hit)
+    return numba.njit(parallel=True, cache=True)(trace_kernel)
+
+def load_numba_kernel():
+    global NUMBA_KERNEL
+    if NUMBA_KERNEL is None:
+        NUMBA_KERNEL = compile_numba_kernel()
+    return NUMBA_KERNEL
+
+def trace_rays_numba(origins, directions, packed, max_depth):
+    kernel = load_numba_kernel()
+    bvh = packed.bvh
+    if bvh is None or not len(bvh.leaves):
+        empty = np.zeros(0, dtype=np.int64)
+        nodes = (np.zeros((0, 3)), np.zeros((0, 3)), empty, empty, empty, empty, empty)
+    else:
+        nodes = (bvh.lows, bvh.highs, bvh.left, bvh.right, bvh.start, bvh.count, bvh.order)
+
+    with profile_stage('numba_kernel', len(origins)):
+        return kernel(np.ascontiguousarray(origins, dtype=np.float64), np.ascontiguousarray(directions, dtype=np.float64),
+                      max_depth, packed.is_sphere, packed.centers, packed.radii, packed.normals, packed.offsets,
+                      packed.colors, packed.reflectiveness, packed.light_positions, packed.light_intensities,
+                      packed.sphere_ids, packed.wall_ids, *nodes)
+
+def render_chunk_batched(y_start, y_end, scene, width, max_depth, samples_per_pixel, x_start=0, x_end=None, packed=None,
+                         quantize=True):
     camera = scene['camera']
-    chunk_image = np.zeros((y_end - y_start, width, 3), dtype=np.uint8)
+    if packed is None:
+        packed = PackedScene(scene['objects'], scene['lights'], backend=scene.get('backend', 'numpy'))
+    x_end = width if x_end is None else x_end
+    chunk_width = x_end - x_start
+    chunk_image = np.zeros((y_end - y_start, chunk_width, 3), dtype=np.uint8 if quantize else np.float64)
+    rows_per_packet = max(PACKET_SIZE // (chunk_width * samples_per_pixel), 1)
+
+    for y0 in range(y_start, y_end, rows_per_packet):
+        y1 = min(y0 + rows_per_packet, y_end)
+        ys, xs = np.mgrid[y0:y1, x_start:x_end]
+        xs = np.repeat(xs.ravel(), samples_per_pixel)
+        ys = np.repeat(ys.ravel(), samples_per_pixel)
+        dx = np.random.random(len(xs))
+        dy = np.random.random(len(ys))
+
+        with profile_stage('camera_rays', len(xs)):
+            origins, directions = camera_rays(camera, xs, ys, dx, dy)
+        colors = trace_rays(origins, directions, packed, max_depth)
+        colors = colors.reshape(y1 - y0, chunk_width, samples_per_pixel, 3).mean(axis=2)
+        chunk_image[y0 - y_start:y1 - y_start] = np.clip(colors * 255, 0, 255) if quantize else colors * 255
+
+    return chunk_image
+
+ADAPTIVE_MIN_SAMPLES = 2
+ADAPTIVE_THRESHOLD = 4 / 255
+
+def accumulate_samples(sums, squares, counts, pixels, colors):
+    size = len(counts)
+    for channel in range(3):
+        sums[:, channel] += np.bincount(pixels, colors[:, channel], minlength=size)
+    squares += np.bincount(pixels, colors.mean(axis=1) ** 2, minlength=size)
+    counts += np.bincount(pixels, minlength=size)
+
+def neighbour_contrast(luminance):
+    padded = np.pad(luminance, 1, mode='edge')
+    rows, cols = luminance.shape
+    contrast = np.zeros_like(luminance)
+    for dy in range(3):
+        for dx in range(3):
+            contrast = np.maximum(contrast, np.abs(padded[dy:dy + rows, dx:dx + cols] - luminance))
+    return contrast
+
+def render_chunk_adaptive(y_start, y_end, scene, width, max_depth, max_samples, x_start=0, x_end=None, packed=None,
+                          quantize=True):
+    camera = scene['camera']
+    if packed is None:
+        packed = PackedScene(scene['objects'], scene['lights'], backend=scene.get('backend', 'numpy'))
+    x_end = width if x_end is None else x_end
+    rows, cols = y_end - y_start, x_end - x_start
+    ys, xs = np.mgrid[y_start:y_end, x_start:x_end]
+    xs, ys = xs.ravel(), ys.ravel()
+
+    sums = np.zeros((rows * cols, 3))
+    squares = np.zeros(rows * cols)
+    counts = np.zeros(rows * cols, dtype=np.int64)
+
+    pixels = np.arange(rows * cols)
+    extra = np.full(len(pixels), min(ADAPTIVE_MIN_SAMPLES, max_samples))
+    while len(pixels):
+        samples = np.repeat(pixels, extra)
+        for first in range(0, len(samples), PACKET_SIZE):
+            packet = samples[first:first + PACKET_SIZE]
+            dx = np.random.random(len(packet))
+            dy = np.random.random(len(packet))
+            with profile_stage('camera_rays', len(packet)):
+                origins, directions = camera_rays(camera, xs[packet], ys[packet], dx, dy)
+            colors = trace_rays(origins, directions, packed, max_depth)
+            accumulate_samples(sums, squares, counts, packet, colors)
+
+        means = sums / counts[:, None]
+        luminance = means.mean(axis=1)
+        variance = np.maximum(squares / counts - luminance ** 2, 0)
+        error = np.sqrt(variance / counts)
+        contrast = neighbour_contrast(luminance.reshape(rows, cols)).ravel()
+        refine = (counts < max_samples) & ((contrast > ADAPTIVE_THRESHOLD) | (error > ADAPTIVE_THRESHOLD))
+        pixels = np.flatnonzero(refine)
+        extra = np.minimum(counts[pixels], max_samples - counts[pixels])
+
+    image = sums / counts[:, None] * 255
+    if quantize:
+        image = np.clip(image, 0, 255).astype(np.uint8)
+    return image.reshape(rows, cols, 3)
+
+def render_chunk(y_start, y_end, scene, width, height, fov, max_depth, samples_per_pixel, batched=True, x_start=0, x_end=None, packed=None,
+                 adaptive=False, quantize=True):
+    if adaptive:
+        return render_chunk_adaptive(y_start, y_end, scene, width, max_depth, samples_per_pixel, x_start, x_end, packed, quantize)
+    if batched:
+        return render_chunk_batched(y_start, y_end, scene, width, max_depth, samples_per_pixel, x_start, x_end, packed, quantize)
+
+    camera = scene['camera']
+    x_end = width if x_end is None else x_end
+    chunk_image = np.zeros((y_end - y_start, x_end - x_start, 3), dtype=np.uint8 if quantize else np.float64)
 
     for y in range(y_start, y_end):
-        for x in range(width):
+        for x in range(x_start, x_end):
             color = np.zeros(3, dtype=np.float32)
 
             for _ in range(samples_per_pixel):
@@ -137,21 +790,222 @@ def render_chunk(y_start, y_end, scene, width, height, fov, max_depth, samples_p
                 color += trace_ray(ray, scene['objects'], scene['lights'], 0, max_depth)
 
             color /= samples_per_pixel
-            chunk_image[y - y_start, x] = np.clip(color * 255, 0, 255)
+            chunk_image[y - y_start, x - x_start] = np.clip(color * 255, 0, 255) if quantize else color * 255
 
     return chunk_image
 
-def render(scene, width, height, fov, max_depth, samples_per_pixel=4):
+TILE_SIZE = 32
+
+def make_tiles(width, height, tile_size=TILE_SIZE):
+    return [(x, min(x + tile_size, width), y, min(y + tile_size, height))
+            for y in range(0, height, tile_size) for x in range(0, width, tile_size)]
+
+def estimate_sphere_costs(camera, centers, radii, reflectiveness, tiles, width, height, max_depth):
+    bounds = np.array(tiles, dtype=np.float64).reshape(-1, 4)
+    costs = np.ones(len(tiles))
+    if not len(centers):
+        return costs
+
+    weights = 1 + reflectiveness * max_depth
+    offsets = centers - camera.position
+    depth = offsets @ camera.forward
+
+    straddling = (depth <= radii) & (depth > -radii)
+    costs += weights[straddling].sum()
+
+    visible = depth > radii
+    offsets, depth, radii, weights = offsets[visible], depth[visible], radii[visible], weights[visible]
+    sx = (offsets @ camera.right / depth / (camera.angle * camera.aspect_ratio) + 1) * 0.5 * width
+    sy = (1 - offsets @ camera.up / depth / camera.angle) * 0.5 * height
+    sr = radii / (depth - radii) / camera.angle * 0.5 * height
+    overlap = ((bounds[None, :, 0] < (sx + sr)[:, None]) & (bounds[None, :, 1] > (sx - sr)[:, None]) &
+               (bounds[None, :, 2] < (sy + sr)[:, None]) & (bounds[None, :, 3] > (sy - sr)[:, None]))
+    costs += weights @ overlap
+
+    return costs
+
+def estimate_tile_costs(scene, tiles, width, height, max_depth):
+    spheres = [obj for obj in scene['objects'] if isinstance(obj, Sphere)]
+    centers = np.array([sphere.center for sphere in spheres], dtype=np.float64).reshape(-1, 3)
+    radii = np.array([sphere.radius for sphere in spheres], dtype=np.float64)
+    reflectiveness = np.array([sphere.reflectiveness for sphere in spheres], dtype=np.float64)
+    return estimate_sphere_costs(scene['camera'], centers, radii, reflectiveness, tiles, width, height, max_depth)
+
+def worker_packed_scene(frame, slot):
+    scene = WORKER_SCENES[slot]
+    if slot not in WORKER_PACKED:
+        WORKER_PACKED[slot] = PackedScene(scene['objects'], scene['lights'], backend=scene.get('backend', 'numpy'))
+    elif WORKER_FRAMES.get(slot) != frame:
+        WORKER_PACKED[slot].update()
+    WORKER_FRAMES[slot] = frame
+    return WORKER_PACKED[slot]
+
+def render_tile(task):
+    tile, cost, frame, slot, width, height, max_depth, samples_per_pixel, batched, adaptive, quantize = task
+    x_start, x_end, y_start, y_end = tile
+    scene = WORKER_SCENES[slot]
+    start = time.perf_counter()
+    packed = worker_packed_scene(frame, slot) if batched or adaptive else None
+    tile_image = render_chunk(y_start, y_end, scene, width, height, scene['camera'].fov,
+                              max_depth, samples_per_pixel, batched, x_start, x_end, packed, adaptive, quantize)
+    return tile, cost, tile_image, time.perf_counter() - start
+
+def tile_tasks(tiles, costs, frame, slot, width, height, max_depth, samples_per_pixel, batched, adaptive, quantize=True):
+    return [(tiles[i], costs[i], frame, slot, width, height, max_depth, samples_per_pixel, batched, adaptive, quantize)
+            for i in np.argsort(-costs, kind='stable')]
+
+def assemble_tiles(results, width, height, tile_stats=None, quantize=True):
+    image = np.zeros((height, width, 3), dtype=np.uint8 if quantize else np.float64)
+    for tile, cost, tile_image, seconds in results:
+        x_start, x_end, y_start, y_end = tile
+        image[y_start:y_end, x_start:x_end] = tile_image
+        if tile_stats is not None:
+            tile_stats.append({'tile': tile, 'cost': float(cost), 'seconds': seconds})
+
+    return Image.fromarray(image) if quantize else image
+
+def render_tiles(pool, scene, width, height, max_depth, samples_per_pixel, batched, tile_stats=None, frame=0, adaptive=False,
+                 quantize=True):
+    tiles = make_tiles(width, height)
+    costs = estimate_tile_costs(scene, tiles, width, height, max_depth)
+    tasks = tile_tasks(tiles, costs, frame, 0, width, height, max_depth, samples_per_pixel, batched, adaptive, quantize)
+    return assemble_tiles(pool.imap_unordered(render_tile, tasks, chunksize=1), width, height, tile_stats, quantize)
+
+WORKER_SCENES = None
+WORKER_MEMORY = None
+WORKER_PACKED = {}
+WORKER_FRAMES = {}
+
+def limit_worker_threads(scene, processes):
+    if scene.get('backend') == 'numba':
+        import_numba().set_num_threads(max(cpu_count() // processes, 1))
+
+def pool_context():
+    # A process forked after the numba kernel has run here inherits its threading layer and hangs at exit
+    return get_context('spawn' if NUMBA_KERNEL is not None else None)
+
+def attach_scene(scene, processes=1):
+    global WORKER_SCENES
+    WORKER_SCENES = [scene]
+    limit_worker_threads(scene, processes)
+
+def render(scene, width, height, fov, max_depth, samples_per_pixel=4, batched=True, tile_stats=None, adaptive=False, progress=None):
+    if progress is not None:
+        for image, samples in render_progressive(scene, width, height, fov, max_depth, samples_per_pixel, batched):
+            if progress(image, samples):
+                break
+        return image
+
     num_cores = max(cpu_count() - 2, 1) 
-    chunk_size = height // num_cores 
 
-    with Pool(processes=num_cores) as pool:
-        tasks = [(i * chunk_size, (i + 1) * chunk_size if i != num_cores - 1 else height, 
-                  scene, width, height, fov, max_depth, samples_per_pixel) for i in range(num_cores)]
-        chunk_images = pool.starmap(render_chunk, tasks)
+    with pool_context().Pool(processes=num_cores, initializer=attach_scene, initargs=(scene, num_cores)) as pool:
+        return render_tiles(pool, scene, width, height, max_depth, samples_per_pixel, batched, tile_stats, adaptive=adaptive)
+
+PREVIEW_SCALE = 4
+
+def render_preview(scene, width, height, max_depth, scale=PREVIEW_SCALE):
+    packed = PackedScene(scene['objects'], scene['lights'], backend=scene.get('backend', 'numpy'))
+    ys, xs = np.mgrid[0:height:scale, 0:width:scale]
+    rows, cols = xs.shape
+    origins, directions = camera_rays(scene['camera'], xs.ravel(), ys.ravel(), scale / 2, scale / 2)
+
+    colors = np.zeros((rows * cols, 3))
+    for first in range(0, len(colors), PACKET_SIZE):
+        last = first + PACKET_SIZE
+        colors[first:last] = trace_rays(origins[first:last], directions[first:last], packed, max_depth)
+
+    image = np.clip(colors * 255, 0, 255).astype(np.uint8).reshape(rows, cols, 3)
+    return image.repeat(scale, axis=0).repeat(scale, axis=1)[:height, :width]
+
+def render_progressive(scene, width, height, fov, max_depth, samples_per_pixel=4, batched=True, preview_scale=PREVIEW_SCALE):
+    num_cores = max(cpu_count() - 2, 1)
+    # The pool is forked before the in-process preview, while numba has no threads to leave behind
+    with pool_context().Pool(processes=num_cores, initializer=attach_scene, initargs=(scene, num_cores)) as pool:
+        yield Image.fromarray(render_preview(scene, width, height, max_depth, preview_scale)), 0
 
-    image = np.vstack(chunk_images)
-    return Image.fromarray(image)
+        total = np.zeros((height, width, 3))
+        for samples in range(1, samples_per_pixel + 1):
+            # Passes stay unquantized until the average, so truncating each one cannot darken the result
+            total += render_tiles(pool, scene, width, height, max_depth, 1, batched, quantize=False)
+            yield Image.fromarray(np.clip(total / samples, 0, 255).astype(np.uint8)), samples
+
+def attach_render_worker(memory_name, shape, scene, processes=1):
+    global WORKER_SCENES, WORKER_MEMORY
+    limit_worker_threads(scene, processes)
+    WORKER_MEMORY = shared_memory.SharedMemory(name=memory_name)
+    state = np.ndarray(shape, dtype=np.float32, buffer=WORKER_MEMORY.buf)
+
+    WORKER_SCENES = []
+    for slot in range(shape[0]):
+        objects = []
+        i = 0
+        for obj in scene['objects']:
+            if isinstance(obj, Sphere):
+                obj = copy.copy(obj)
+                obj.center = state[slot, i, 0:3]
+                obj.color = state[slot, i, 3:6]
+                i += 1
+            objects.append(obj)
+        WORKER_SCENES.append(dict(scene, objects=objects))
+
+class RenderPool:
+    def __init__(self, scene, processes=None, slots=1):
+        self.processes = processes or max(cpu_count() - 2, 1)
+        self.scene = scene
+        self.slots = slots
+        self.tile_stats = []
+        self.frame = 0
+        self.spheres = [obj for obj in scene['objects'] if isinstance(obj, Sphere)]
+        self.radii = np.array([sphere.radius for sphere in self.spheres], dtype=np.float64)
+        self.reflectiveness = np.array([sphere.reflectiveness for sphere in self.spheres], dtype=np.float64)
+
+        shape = (slots, len(self.spheres), 6)
+        self.memory = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * 4, 1))
+        self.state = np.ndarray(shape, dtype=np.float32, buffer=self.memory.buf)
+        for slot in range(slots):
+            self.update(slot)
+
+        self.pool = pool_context().Pool(processes=self.processes, initializer=attach_render_worker,
+                                        initargs=(self.memory.name, shape, scene, self.processes))
+
+    def update(self, slot=0, centers=None):
+        if not self.spheres:
+            return
+        if centers is None:
+            centers = [sphere.center for sphere in self.spheres]
+        self.state[slot, :, 0:3] = centers
+        self.state[slot, :, 3:6] = [sphere.color for sphere in self.spheres]
+
+    def tasks(self, slot, width, height, max_depth, samples_per_pixel, batched, adaptive, tile_size=TILE_SIZE):
+        self.frame += 1
+        tiles = make_tiles(width, height, tile_size)
+        costs = estimate_sphere_costs(self.scene['camera'], self.state[slot, :, 0:3].astype(np.float64), self.radii,
+                                      self.reflectiveness, tiles, width, height, max_depth)
+        return tile_tasks(tiles, costs, self.frame, slot, width, height, max_depth, samples_per_pixel, batched, adaptive)
+
+    def render(self, width, height, max_depth, samples_per_pixel=4, batched=True, adaptive=False):
+        self.update()
+        self.tile_stats = []
+        tasks = self.tasks(0, width, height, max_depth, samples_per_pixel, batched, adaptive)
+        return assemble_tiles(self.pool.imap_unordered(render_tile, tasks, chunksize=1), width, height, self.tile_stats)
+
+    def submit(self, centers, slot, width, height, max_depth, samples_per_pixel=4, batched=True, adaptive=False, tile_size=TILE_SIZE):
+        self.update(slot, centers)
+        tasks = self.tasks(slot, width, height, max_depth, samples_per_pixel, batched, adaptive, tile_size)
+        return self.pool.map_async(render_tile, tasks, chunksize=1)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        del self.state
+        self.memory.close()
+        self.memory.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
 class Wall:
     def __init__(self, normal, d, color):
@@ -167,9 +1021,113 @@ class Wall:
                 return t
         return None
 
+class VideoStream:
+    def __init__(self, output_file, fps=30, max_pending=4):
+        self.output_file = output_file
+        self.writer = imageio.get_writer(output_file, fps=fps)
+        self.frames = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            frame = self.frames.get()
+            if frame is None:
+                break
+            if self.error is None:
+                try:
+                    self.writer.append_data(frame)
+                except Exception as error:
+                    self.error = error
+
+    def write(self, frame):
+        if self.error is not None:
+            raise self.error
+        self.frames.put(frame)
+
+    def close(self):
+        self.frames.put(None)
+        self.thread.join()
+        self.writer.close()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+NEIGHBOUR_OFFSETS = np.array([(dx, dy, dz) for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1)], dtype=np.int64)
+
+def broadphase_pairs(centers, radii):
+    count = len(centers)
+    cell_size = 2 * radii.max() if count else 0
+    if count < 2 or cell_size <= 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    cells = np.floor(centers / cell_size).astype(np.int64)
+    cells -= cells.min(axis=0) - 1
+    dims = cells.max(axis=0) + 2
+    keys = (cells[:, 0] * dims[1] + cells[:, 1]) * dims[2] + cells[:, 2]
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+
+    firsts, seconds = [], []
+    for dx, dy, dz in NEIGHBOUR_OFFSETS:
+        neighbour_keys = keys + (dx * dims[1] + dy) * dims[2] + dz
+        low = np.searchsorted(sorted_keys, neighbour_keys, side='left')
+        high = np.searchsorted(sorted_keys, neighbour_keys, side='right')
+        counts = high - low
+        total = counts.sum()
+        if not total:
+            continue
+        first = np.repeat(np.arange(count), counts)
+        rank = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        second = order[np.repeat(low, counts) + rank]
+        keep = first < second
+        firsts.append(first[keep])
+        seconds.append(second[keep])
+
+    if not firsts:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(firsts), np.concatenate(seconds)
+
+def colliding_pairs(centers, radii):
+    first, second = broadphase_pairs(centers, radii)
+    distance = np.linalg.norm(centers[first] - centers[second], axis=1)
+    colliding = distance < radii[first] + radii[second]
+    first, second = first[colliding], second[colliding]
+    order = np.lexsort((second, first))
+    return first[order], second[order]
+
+def contact_batches(first, second, count):
+    # Each round takes the pairs that are the earliest pending contact of both their spheres, so pairs sharing
+    # a sphere are resolved one after another in (i, j) order while independent pairs go through together
+    pending = np.arange(len(first))
+    while len(pending):
+        earliest = np.full(count, len(first))
+        np.minimum.at(earliest, first[pending], pending)
+        np.minimum.at(earliest, second[pending], pending)
+        ready = (earliest[first[pending]] == pending) & (earliest[second[pending]] == pending)
+        yield pending[ready]
+        pending = pending[~ready]
+
+def write_atomic(path, data):
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'wb') as output_file:
+        output_file.write(data)
+    os.replace(temporary_path, path)
+
+FRAME_PARALLEL_TILES = 4
+
 ZERO_G = False
 class ElasticCollisionSimulator:
-    def __init__(self, spheres, walls, lights, camera, width, height, max_depth, num_frames, time_step, output_dir='frames'):
+    def __init__(self, spheres, walls, lights, camera, width, height, max_depth, num_frames, time_step, output_dir='frames',
+                 video_file='output.mp4', fps=30, save_frames=False, samples_per_pixel=4, adaptive_sampling=False,
+                 substeps=1, pipelined=False, pipeline_depth=2, checkpoint_every=0, resume=False, backend='numpy',
+                 parallelism='auto'):
         self.spheres = spheres
         self.walls = walls
         self.lights = lights
@@ -180,102 +1138,498 @@ class ElasticCollisionSimulator:
         self.num_frames = num_frames
         self.time_step = time_step
         self.output_dir = output_dir
+        self.video_file = video_file
+        self.fps = fps
+        self.save_frames = save_frames
+        self.samples_per_pixel = samples_per_pixel
+        self.adaptive_sampling = adaptive_sampling
+        self.substeps = substeps
+        self.backend = backend
+        self.pipelined = pipelined
+        self.pipeline_depth = pipeline_depth
+        self.parallelism = parallelism
+        self.render_pool = None
+        self.video_stream = None
+        self.physics_error = None
+        self.checkpoint_every = checkpoint_every
+        self.resume = resume
+        self.completed_frames = set()
+        self.start_frame = 0
+        if self.resume and not self.checkpoint_every:
+            raise ValueError("Cannot resume without checkpoint_every, frames are only kept on disk when checkpointing")
+        if self.checkpoint_every:
+            self.save_frames = True
+
+        self.positions = np.array([sphere.center for sphere in spheres], dtype=np.float32).reshape(-1, 3)
+        self.velocities = np.array([sphere.velocity for sphere in spheres], dtype=np.float32).reshape(-1, 3)
+        self.radii = np.array([sphere.radius for sphere in spheres], dtype=np.float32)
+        self.masses = np.array([sphere.mass for sphere in spheres], dtype=np.float32)
+        self.bind_spheres()
 
-        if os.path.exists(self.output_dir):
-            shutil.rmtree(self.output_dir)
-        os.makedirs(self.output_dir)
+        if self.save_frames:
+            if os.path.exists(self.output_dir) and not self.resume:
+                shutil.rmtree(self.output_dir)
+            os.makedirs(self.output_dir, exist_ok=True)
+            if self.resume:
+                self.load_checkpoint()
 
     def simulate(self):
-        for frame in range(self.num_frames):
-            P_BAR.update()
-            self.update_positions()
+        P_BAR.update(self.start_frame)
+        processes = max(cpu_count() - 2, 1)
+        if self.choose_parallelism(processes) == 'frames':
+            self.simulate_frames(processes)
+        elif self.pipelined:
+            self.simulate_pipelined()
+        else:
+            with RenderPool(self.build_scene()) as pool:
+                self.render_pool = pool
+                self.open_video()
+                try:
+                    for frame in range(self.start_frame, self.num_frames):
+                        P_BAR.update()
+                        self.step()
+                        if frame not in self.completed_frames:
+                            self.render_frame(frame)
+                        self.record_frame(frame, self.positions, self.velocities)
+                finally:
+                    self.render_pool = None
+                    self.close_video()
+
+        if self.video_file and self.checkpoint_every:
+            self.compile_frames_to_video(self.video_file, self.fps)
+
+    def simulate_pipelined(self):
+        snapshots = queue.Queue(maxsize=self.pipeline_depth)
+        producer = threading.Thread(target=self.run_physics, args=(snapshots,), daemon=True)
+        in_flight = deque()
+
+        with RenderPool(self.build_scene(), slots=self.pipeline_depth) as pool:
+            self.open_video()
+            producer.start()
+            try:
+                while True:
+                    snapshot = snapshots.get()
+                    if snapshot is None:
+                        break
+                    frame, positions, velocities = snapshot
+                    if len(in_flight) == self.pipeline_depth:
+                        self.finish_frame(*in_flight.popleft())
+                    result = None
+                    if frame not in self.completed_frames:
+                        result = pool.submit(positions, frame % self.pipeline_depth, self.width, self.height, self.max_depth,
+                                             self.samples_per_pixel, adaptive=self.adaptive_sampling)
+                    in_flight.append((frame, result, positions, velocities))
+
+                while in_flight:
+                    self.finish_frame(*in_flight.popleft())
+                producer.join()
+                if self.physics_error is not None:
+                    raise self.physics_error
+            finally:
+                self.close_video()
+
+    def choose_parallelism(self, processes):
+        if self.parallelism != 'auto':
+            return self.parallelism
+        tiles = len(make_tiles(self.width, self.height))
+        frames = self.num_frames - self.start_frame
+        return 'frames' if tiles < FRAME_PARALLEL_TILES * processes and frames >= processes else 'tiles'
+
+    def record_trajectory(self):
+        trajectory = []
+        for frame in range(self.start_frame, self.num_frames):
+            self.step()
+            trajectory.append((frame, self.positions.copy(), self.velocities.copy()))
+        return trajectory
+
+    def simulate_frames(self, processes):
+        trajectory = self.record_trajectory()
+        slots = 2 * processes
+        in_flight = deque()
+
+        with RenderPool(self.build_scene(), processes, slots=slots) as pool:
+            self.open_video()
+            try:
+                for frame, positions, velocities in trajectory:
+                    if len(in_flight) == slots:
+                        self.finish_frame(*in_flight.popleft())
+                    result = None
+                    if frame not in self.completed_frames:
+                        result = pool.submit(positions, frame % slots, self.width, self.height, self.max_depth,
+                                             self.samples_per_pixel, adaptive=self.adaptive_sampling,
+                                             tile_size=max(self.width, self.height))
+                    in_flight.append((frame, result, positions, velocities))
+
+                while in_flight:
+                    self.finish_frame(*in_flight.popleft())
+            finally:
+                self.close_video()
+
+    def run_physics(self, snapshots):
+        try:
+            for frame in range(self.start_frame, self.num_frames):
+                self.step()
+                snapshots.put((frame, self.positions.copy(), self.velocities.copy()))
+        except Exception as error:
+            self.physics_error = error
+        finally:
+            snapshots.put(None)
+
+    def finish_frame(self, frame_number, result, positions, velocities):
+        P_BAR.update()
+        if result is not None:
+            tile_stats = []
+            image = assemble_tiles(result.get(), self.width, self.height, tile_stats)
+            slowest = max(stat['seconds'] for stat in tile_stats)
+            P_BAR.set_postfix(tiles=len(tile_stats), slowest_tile=f'{slowest * 1000:.0f}ms')
+            self.write_frame(frame_number, image)
+        self.record_frame(frame_number, positions, velocities)
+
+    def open_video(self):
+        stream = self.video_file and not self.checkpoint_every
+        self.video_stream = VideoStream(self.video_file, self.fps) if stream else None
+
+    def close_video(self):
+        if self.video_stream is not None:
+            self.video_stream.close()
+            self.video_stream = None
+            print(f"Video saved as {self.video_file}")
+
+    def frame_path(self, frame_number):
+        return f'{self.output_dir}/frame_{frame_number:04d}.png'
+
+    def manifest_path(self):
+        return os.path.join(self.output_dir, 'manifest.json')
+
+    def checkpoint_path(self):
+        return os.path.join(self.output_dir, 'checkpoint.pkl')
+
+    def run_settings(self):
+        return {
+            'num_frames': self.num_frames,
+            'time_step': self.time_step,
+            'substeps': self.substeps,
+            'width': self.width,
+            'height': self.height,
+            'spheres': len(self.spheres)
+        }
+
+    def load_checkpoint(self):
+        if os.path.exists(self.manifest_path()):
+            with open(self.manifest_path()) as manifest_file:
+                manifest = json.load(manifest_file)
+            if manifest['settings'] != self.run_settings():
+                raise ValueError(f"Cannot resume: {self.output_dir} was rendered with different settings")
+            self.completed_frames = {frame for frame in manifest['completed'] if os.path.exists(self.frame_path(frame))}
+
+        if os.path.exists(self.checkpoint_path()):
+            with open(self.checkpoint_path(), 'rb') as checkpoint_file:
+                checkpoint = pickle.load(checkpoint_file)
+            # A frame missing before the checkpoint can only be re-rendered by stepping the physics again from frame 0
+            if self.completed_frames.issuperset(range(checkpoint['frame'] + 1)):
+                self.positions[:] = checkpoint['positions']
+                self.velocities[:] = checkpoint['velocities']
+                np.random.set_state(checkpoint['numpy_random'])
+                random.setstate(checkpoint['random'])
+                self.start_frame = checkpoint['frame'] + 1
+
+    def record_frame(self, frame_number, positions, velocities):
+        if not self.save_frames:
+            return
+        self.completed_frames.add(frame_number)
+        write_atomic(self.manifest_path(), json.dumps({
+            'settings': self.run_settings(),
+            'completed': sorted(self.completed_frames)
+        }).encode())
+
+        if self.checkpoint_every and (frame_number + 1) % self.checkpoint_every == 0:
+            write_atomic(self.checkpoint_path(), pickle.dumps({
+                'frame': frame_number,
+                'positions': positions,
+                'velocities': velocities,
+                'radii': self.radii,
+                'masses': self.masses,
+                'numpy_random': np.random.get_state(),
+                'random': random.getstate()
+            }))
+
+    def step(self):
+        dt = self.time_step / self.substeps
+        for _ in range(self.substeps):
+            self.update_positions(dt)
             self.handle_collisions()
-            self.render_frame(frame)
 
-    def update_positions(self):
-        for sphere in self.spheres:
-            sphere.center += sphere.velocity * self.time_step
+    def bind_spheres(self):
+        for i, sphere in enumerate(self.spheres):
+            sphere.center = self.positions[i]
+            sphere.velocity = self.velocities[i]
 
-            self.handle_boundary_collision(sphere)
+    def update_positions(self, dt=None):
+        self.positions += self.velocities * (self.time_step if dt is None else dt)
+        self.handle_boundary_collision()
 
-    def handle_boundary_collision(self, sphere):
+    def handle_boundary_collision(self):
         min_boundary, max_boundary = -10, 10 
 
-        for i in range(3):
-            coord = sphere.center[i]
-            velocity = sphere.velocity[i]
-            if coord - sphere.radius < min_boundary or coord + sphere.radius > max_boundary:
-                sphere.velocity[i] = -velocity
+        radii = self.radii[:, None]
+        outside = (self.positions - radii < min_boundary) | (self.positions + radii > max_boundary)
+        np.negative(self.velocities, out=self.velocities, where=outside)
 
     def handle_collisions(self):
-        for i in range(len(self.spheres)):
-            for j in range(i + 1, len(self.spheres)):
-                if self.are_spheres_colliding(self.spheres[i], self.spheres[j]):
-                    self.resolve_collision(self.spheres[i], self.spheres[j])
+        if len(self.spheres) < 2:
+            return
+        first, second = colliding_pairs(self.positions, self.radii)
+        for batch in contact_batches(first, second, len(self.spheres)):
+            self.resolve_collisions(first[batch], second[batch])
 
     def are_spheres_colliding(self, sphere1, sphere2):
         distance = np.linalg.norm(sphere1.center - sphere2.center)
         return distance < (sphere1.radius + sphere2.radius)
 
-    def resolve_collision(self, sphere1, sphere2):
-        normal = (sphere1.center - sphere2.center) / np.linalg.norm(sphere1.center - sphere2.center)
-        relative_velocity = sphere1.velocity - sphere2.velocity
-        velocity_along_normal = relative_velocity.dot(normal)
+    def resolve_collisions(self, first, second):
+        offset = self.positions[first] - self.positions[second]
+        normal = offset / np.linalg.norm(offset, axis=1, keepdims=True)
+        relative_velocity = self.velocities[first] - self.velocities[second]
+        velocity_along_normal = np.einsum('ij,ij->i', relative_velocity, normal)
 
-        if velocity_along_normal > 0:
-            return 
+        approaching = velocity_along_normal <= 0
+        first, second = first[approaching], second[approaching]
+        normal, velocity_along_normal = normal[approaching], velocity_along_normal[approaching]
+        if not len(first):
+            return
 
         restitution = 1
         impulse_scalar = -(1 + restitution) * velocity_along_normal
-        impulse_scalar /= (1 / sphere1.mass + 1 / sphere2.mass)
+        impulse_scalar /= (1 / self.masses[first] + 1 / self.masses[second])
 
-        impulse = normal * impulse_scalar
-        sphere1.velocity += impulse * (1 / sphere1.mass)
-        sphere2.velocity -= impulse * (1 / sphere2.mass)
+        # contact_batches never puts a sphere in two pairs of one call, so plain fancy indexing is safe
+        impulse = normal * impulse_scalar[:, None]
+        self.velocities[first] += impulse / self.masses[first, None]
+        self.velocities[second] -= impulse / self.masses[second, None]
         if not ZERO_G:
-            sphere1.velocity = np.array([sphere1.velocity[0], 0, sphere1.velocity[2]]) 
-            sphere2.velocity = np.array([sphere2.velocity[0], 0, sphere2.velocity[2]])
+            self.velocities[first, 1] = 0
+            self.velocities[second, 1] = 0
 
-    def render_frame(self, frame_number):
-        scene = {
+    def build_scene(self):
+        return {
             'camera': self.camera,
             'objects': self.spheres + self.walls,
-            'lights': self.lights
+            'lights': self.lights,
+            'backend': self.backend
         }
-        image = render(scene, self.width, self.height, self.camera.fov, self.max_depth)
-        image.save(f'{self.output_dir}/frame_{frame_number:04d}.png')
+
+    def render_frame(self, frame_number):
+        if self.render_pool is not None:
+            image = self.render_pool.render(self.width, self.height, self.max_depth, self.samples_per_pixel,
+                                            adaptive=self.adaptive_sampling)
+            slowest = max(stat['seconds'] for stat in self.render_pool.tile_stats)
+            P_BAR.set_postfix(tiles=len(self.render_pool.tile_stats), slowest_tile=f'{slowest * 1000:.0f}ms')
+        else:
+            image = render(self.build_scene(), self.width, self.height, self.camera.fov, self.max_depth,
+                           self.samples_per_pixel, adaptive=self.adaptive_sampling)
+        self.write_frame(frame_number, image)
+
+    def write_frame(self, frame_number, image):
+        if self.save_frames:
+            image.save(self.frame_path(frame_number))
+        if self.video_stream is not None:
+            self.video_stream.write(np.asarray(image))
 
     def compile_frames_to_video(self, output_file='output.mp4', fps=30):
         with imageio.get_writer(output_file, fps=fps) as video_writer:
             for frame in range(self.num_frames):
-                frame_path = f'{self.output_dir}/frame_{frame:04d}.png'
-                video_writer.append_data(imageio.imread(frame_path))
+                video_writer.append_data(imageio.imread(self.frame_path(frame)))
         print(f"Video saved as {output_file}")
 
+BENCHMARK_SCENES = {'default': 4, 'spheres_100': 100, 'spheres_10k': 10000}
+
+def default_scene(width, height, fov=70):
+    camera = Camera(position=np.array([0, 5, -10]), target=np.array([0, 0, 0]), fov=fov, aspect_ratio=width / height, width=width, height=height)
+    lights = [Light(position=np.array([5, 5, -5]), intensity=1.5)]
+    spheres = [
+        Sphere(center=np.array([-2, 0, 0]), radius=1, color=np.array([1, 0, 0]), reflectiveness=0.2, velocity=np.array([1, 0, 0]), mass=1),
+        Sphere(center=np.array([2, 0, 0]), radius=1, color=np.array([0, 1, 0]), reflectiveness=0.3, velocity=np.array([-1, 0, 0]), mass=1),
+        Sphere(center=np.array([0, 0, 2]), radius=1, color=np.array([0, 0, 1]), reflectiveness=0.4, velocity=np.array([0, 0, -1]), mass=1),
+        Sphere(center=np.array([0, 2, -2]), radius=1, color=np.array([1, 1, 0]), reflectiveness=0.1, velocity=np.array([0, -0.5, 1]), mass=1)
+    ]
+    return camera, lights, spheres
+
+def random_spheres(count, seed):
+    rng = np.random.default_rng(seed)
+    radius = 4.0 / count ** (1 / 3)
+    return [Sphere(center=rng.uniform(-8, 8, 3), radius=radius, color=rng.random(3), reflectiveness=rng.choice([0, 0.2, 0.4]),
+                   velocity=rng.normal(0, 1, 3), mass=1) for _ in range(count)]
+
+def benchmark_scene(name, width, height, seed, backend='numpy'):
+    camera, lights, spheres = default_scene(width, height)
+    if name != 'default':
+        spheres = random_spheres(BENCHMARK_SCENES[name], seed)
+    return {'camera': camera, 'objects': spheres, 'lights': lights, 'backend': backend}
+
+def profile_frame(scene, width, height, max_depth, samples_per_pixel, seed):
+    global PROFILE
+    packed = PackedScene(scene['objects'], scene['lights'], backend=scene.get('backend', 'numpy'))
+    trace_rays(np.zeros((1, 3)), np.ones((1, 3)), packed, max_depth)
+    Image.fromarray(np.zeros((1, 1, 3), dtype=np.uint8)).save(io.BytesIO(), format='PNG')
+
+    np.random.seed(seed)
+    PROFILE = {'seconds': {}, 'rays': {}}
+    try:
+        start = time.perf_counter()
+        with profile_stage('scene_packing'):
+            packed = PackedScene(scene['objects'], scene['lights'], backend=scene.get('backend', 'numpy'))
+        image = render_chunk(0, height, scene, width, height, scene['camera'].fov, max_depth, samples_per_pixel, packed=packed)
+        with profile_stage('png_encoding'):
+            Image.fromarray(image).save(io.BytesIO(), format='PNG')
+        total = time.perf_counter() - start
+    finally:
+        profile, PROFILE = PROFILE, None
+
+    # Tracing allocations slows every stage down, so peak memory gets its own untimed pass
+    np.random.seed(seed)
+    tracemalloc.start()
+    try:
+        packed = PackedScene(scene['objects'], scene['lights'], backend=scene.get('backend', 'numpy'))
+        image = render_chunk(0, height, scene, width, height, scene['camera'].fov, max_depth, samples_per_pixel, packed=packed)
+        Image.fromarray(image).save(io.BytesIO(), format='PNG')
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    stages = profile['seconds']
+    stages['other'] = max(total - sum(stages.values()), 0.0)
+    camera_ray_count = profile['rays'].get('camera_rays', 0)
+    return {
+        'seconds': total,
+        'stages': stages,
+        'camera_rays': camera_ray_count,
+        'traced_rays': sum(count for stage, count in profile['rays'].items() if stage != 'camera_rays'),
+        'rays_per_second': camera_ray_count / total,
+        'peak_memory_bytes': peak_memory
+    }
+
+def benchmark_scaling(scene, width, height, max_depth, samples_per_pixel, seed, worker_counts, camera_ray_count):
+    results = []
+    for workers in worker_counts:
+        np.random.seed(seed)
+        start = time.perf_counter()
+        with RenderPool(scene, processes=workers) as pool:
+            startup = time.perf_counter() - start
+            start = time.perf_counter()
+            pool.render(width, height, max_depth, samples_per_pixel)
+            first_frame = time.perf_counter() - start
+            start = time.perf_counter()
+            pool.render(width, height, max_depth, samples_per_pixel)
+            wall = time.perf_counter() - start
+            busy = sum(stat['seconds'] for stat in pool.tile_stats)
+
+        results.append({
+            'workers': workers,
+            'pool_startup_seconds': startup,
+            'first_frame_seconds': first_frame,
+            'render_seconds': wall,
+            'pool_overhead_seconds': max(wall - busy / workers, 0.0),
+            'rays_per_second': camera_ray_count / wall,
+            'speedup': results[0]['render_seconds'] / wall if results else 1.0
+        })
+
+    return results
+
+def compare_benchmarks(baseline, results):
+    for name, result in results['scenes'].items():
+        if name not in baseline.get('scenes', {}):
+            continue
+        old = baseline['scenes'][name]['profile']['rays_per_second']
+        new = result['profile']['rays_per_second']
+        print(f"{name}: {old:,.0f} -> {new:,.0f} rays/s ({new / old - 1:+.1%})")
+
+def run_benchmark(scene_names, width, height, max_depth, samples_per_pixel, worker_counts, seed, backend,
+                  output_file='benchmark.json', baseline_file=None):
+    results = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'settings': {
+            'width': width,
+            'height': height,
+            'max_depth': max_depth,
+            'samples_per_pixel': samples_per_pixel,
+            'seed': seed,
+            'backend': backend,
+            'cpu_count': cpu_count()
+        },
+        'scenes': {}
+    }
+
+    for name in scene_names:
+        scene = benchmark_scene(name, width, height, seed, backend)
+        profile = profile_frame(scene, width, height, max_depth, samples_per_pixel, seed)
+        scaling = benchmark_scaling(scene, width, height, max_depth, samples_per_pixel, seed, worker_counts, profile['camera_rays'])
+        results['scenes'][name] = {'profile': profile, 'scaling': scaling}
+
+        stages = ', '.join(f"{stage} {seconds * 1000:.0f}ms" for stage, seconds in sorted(profile['stages'].items(), key=lambda item: -item[1]))
+        print(f"{name}: {profile['rays_per_second']:,.0f} rays/s, peak {profile['peak_memory_bytes'] / 2 ** 20:.1f} MiB ({stages})")
+        for entry in scaling:
+            print(f"  {entry['workers']:3d} workers: {entry['render_seconds']:.3f}s, {entry['speedup']:.2f}x")
+
+    with open(output_file, 'w') as output:
+        json.dump(results, output, indent=2)
+    print(f"Benchmark results saved as {output_file}")
+
+    if baseline_file:
+        with open(baseline_file) as baseline:
+            compare_benchmarks(json.load(baseline), results)
+    return results
+
 P_BAR = None
 
 def main():
     global P_BAR 
+    parser = argparse.ArgumentParser(description='Render an elastic collision animation.')
+    parser.add_argument('--checkpoint-every', type=int, default=0, help='Save frames and a physics checkpoint every N frames')
+    parser.add_argument('--resume', action='store_true', help='Skip frames already rendered into the output directory')
+    parser.add_argument('--backend', choices=['numpy', 'numba'], default='numpy', help='Ray tracing kernels to use')
+    parser.add_argument('--benchmark', action='store_true', help='Profile the standard scenes instead of rendering an animation')
+    parser.add_argument('--benchmark-scenes', nargs='+', choices=list(BENCHMARK_SCENES), default=list(BENCHMARK_SCENES), help='Scenes to benchmark')
+    parser.add_argument('--benchmark-size', type=int, nargs=2, default=[200, 152], help='Benchmark resolution (width, height)')
+    parser.add_argument('--benchmark-workers', type=int, nargs='+', help='Worker counts for the scaling runs')
+    parser.add_argument('--benchmark-output', default='benchmark.json', help='JSON file for the benchmark results')
+    parser.add_argument('--benchmark-baseline', help='Earlier benchmark JSON to compare against')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for benchmark scenes and sampling')
+    parser.add_argument('--parallelism', choices=['auto', 'tiles', 'frames'], default='auto',
+                        help='Split each frame into tiles, render whole frames in parallel, or pick from the resolution')
+    parser.add_argument('--preview', metavar='FILE', help='Progressively render the first frame into FILE and exit')
+    args = parser.parse_args()
+    if args.resume and not args.checkpoint_every:
+        parser.error("--resume needs --checkpoint-every")
+
+    if args.benchmark:
+        worker_counts = args.benchmark_workers or sorted({1, 2, 4, 8, 16, 32, cpu_count()} & set(range(1, cpu_count() + 1)))
+        run_benchmark(args.benchmark_scenes, *args.benchmark_size, 5, 4, worker_counts, args.seed, args.backend,
+                      args.benchmark_output, args.benchmark_baseline)
+        return
+
     width, height = 800, 608
     fov = 70
     max_depth = 5
     num_frames = 60  
     time_step = 0.05 
-    P_BAR = tqdm(range(num_frames))
 
-    camera = Camera(position=np.array([0, 5, -10]), target=np.array([0, 0, 0]), fov=fov, aspect_ratio=width / height, width=width, height=height)
-    lights = [Light(position=np.array([5, 5, -5]), intensity=1.5)]
-    spheres = [
-        Sphere(center=np.array([-2, 0, 0]), radius=1, color=np.array([1, 0, 0]), reflectiveness=0.2, velocity=np.array([1, 0, 0]), mass=1),
-        Sphere(center=np.array([2, 0, 0]), radius=1, color=np.array([0, 1, 0]), reflectiveness=0.3, velocity=np.array([-1, 0, 0]), mass=1),
-        Sphere(center=np.array([0, 0, 2]), radius=1, color=np.array([0, 0, 1]), reflectiveness=0.4, velocity=np.array([0, 0, -1]), mass=1),
-        Sphere(center=np.array([0, 2, -2]), radius=1, color=np.array([1, 1, 0]), reflectiveness=0.1, velocity=np.array([0, -0.5, 1]), mass=1)
-    ]
+    camera, lights, spheres = default_scene(width, height, fov)
     walls = [] 
 
-    simulator = ElasticCollisionSimulator(spheres, walls, lights, camera, width, height, max_depth, num_frames, time_step)
+    if args.preview:
+        scene = {'objects': spheres + walls, 'lights': lights, 'camera': camera, 'backend': args.backend}
+        P_BAR = tqdm(total=4, desc='preview')
+        for image, samples in render_progressive(scene, width, height, fov, max_depth, 4):
+            image.save(args.preview)
+            P_BAR.n = samples
+            P_BAR.refresh()
+        return
+
+    P_BAR = tqdm(range(num_frames))
+    simulator = ElasticCollisionSimulator(spheres, walls, lights, camera, width, height, max_depth, num_frames, time_step,
+                                          checkpoint_every=args.checkpoint_every, resume=args.resume, backend=args.backend,
+                                          parallelism=args.parallelism)
     simulator.simulate()
-    simulator.compile_frames_to_video()
 
 if __name__ == '__main__':
     main()
@@ -1,3 +1,5 @@
+import math
+
 import numpy as np
 from scipy.interpolate import interp1d
 import matplotlib.pyplot as plt
@@ -5,6 +7,9 @@ from tabulate import tabulate
 
 # Constants
 G = 6.67430e-11  # gravitational constant
+DENSITY_TABLE_STEP = 10.0  # altitude spacing of the precomputed density table (m)
+CHUNK_SIZE = 4096  # trajectory rows allocated at a time
+SCALAR_TAIL = 8  # batched cases still in flight below which the scalar loop is cheaper
 
 class Bullet:
     def __init__(self, name, initial_velocity, mass, frontal_area, drag_coefficient):
@@ -30,6 +35,14 @@ class Planet:
         self.atmospheric_data = atmospheric_data
         self.atmospheric_density = interp1d(atmospheric_data['Altitude'], atmospheric_data['Air Density'], kind='cubic')
 
+        # Sample the cubic fit once so lookups are a linear interpolation in a regular table
+        self.min_altitude = min(atmospheric_data['Altitude'])
+        self.max_altitude = max(atmospheric_data['Altitude'])
+        count = int(np.ceil((self.max_altitude - self.min_altitude) / DENSITY_TABLE_STEP)) + 1
+        self.density_altitudes = np.linspace(self.min_altitude, self.max_altitude, count)
+        self.density_step = (self.max_altitude - self.min_altitude) / max(count - 1, 1)
+        self.density_table = self.atmospheric_density(self.density_altitudes)
+
     def __str__(self):
         # Calculate gravity and atmospheric density at the surface
         gravity = self.get_gravity(0)
@@ -50,48 +63,246 @@ class Planet:
         return G * self.mass / (self.radius + altitude)**2
 
     def get_atmospheric_density(self, altitude):
-        # Cap the altitude to be within the range of the atmospheric data
-        altitude = min(max(altitude, min(self.atmospheric_data['Altitude'])), max(self.atmospheric_data['Altitude']))
+        # Altitudes outside the atmospheric data are capped to its range by the table lookup
+        return np.interp(altitude, self.density_altitudes, self.density_table)
+
+class TrajectoryBuffer:
+    # Rows of (x, y, vx, vy), grown a chunk at a time instead of copying the whole trajectory every step
+    def __init__(self):
+        self.chunks = [np.empty((CHUNK_SIZE, 4))]
+        self.count = 0
+
+    def append(self, x, y, vx, vy):
+        if self.count == CHUNK_SIZE:
+            self.chunks.append(np.empty((CHUNK_SIZE, 4)))
+            self.count = 0
+        self.chunks[-1][self.count] = (x, y, vx, vy)
+        self.count += 1
+
+    def to_arrays(self):
+        rows = np.concatenate(self.chunks[:-1] + [self.chunks[-1][:self.count]])
+        return rows[:, :2], rows[:, 2:]
+
+def acceleration_function(bullet, planet):
+    # Returns a scalar acceleration(y, vx, vy) with the bullet and planet constants bound
+    gravitational_parameter = G * planet.mass
+    radius = planet.radius
+    drag_factor = 0.5 * bullet.frontal_area * bullet.drag_coefficient / bullet.mass
+    lowest, highest, step = planet.min_altitude, planet.max_altitude, planet.density_step
+    table = planet.density_table.tolist()
+    last = len(table) - 2
+
+    def acceleration(y, vx, vy):
+        gravity = gravitational_parameter / (radius + y) ** 2
+        offset = (min(max(y, lowest), highest) - lowest) / step
+        i = min(int(offset), last)
+        atmospheric_density = table[i] + (offset - i) * (table[i + 1] - table[i])
 
-        # Return the interpolated air density
-        return self.atmospheric_density(altitude)
+        # drag_force / (mass * speed), with drag_force = 0.5 * rho * A * Cd * speed^2
+        drag = drag_factor * atmospheric_density * math.sqrt(vx * vx + vy * vy)
+        return -drag * vx, -gravity - drag * vy
 
-def simulate_trajectory(bullet, planet, angle, time_step):
+    return acceleration
+
+# Dormand-Prince 5(4) coefficients
+DP_C = (0, 1 / 5, 3 / 10, 4 / 5, 8 / 9, 1, 1)
+DP_A = ((),
+        (1 / 5,),
+        (3 / 40, 9 / 40),
+        (44 / 45, -56 / 15, 32 / 9),
+        (19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729),
+        (9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656),
+        (35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84))
+DP_B = (35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84, 0)
+DP_E = (71 / 57600, 0, -71 / 16695, 71 / 1920, -17253 / 339200, 22 / 525, -1 / 40)
+
+def rk45_step(acceleration, state, h):
+    # One Dormand-Prince step on (x, y, vx, vy); returns the 5th order state and the error estimate
+    stages = []
+    for a in DP_A:
+        stage_state = state + h * sum(coefficient * stage for coefficient, stage in zip(a, stages)) if a else state
+        ax, ay = acceleration(stage_state[1], stage_state[2], stage_state[3])
+        stages.append(np.array([stage_state[2], stage_state[3], ax, ay]))
+    new_state = state + h * sum(b * stage for b, stage in zip(DP_B, stages))
+    error = h * sum(e * stage for e, stage in zip(DP_E, stages))
+    return new_state, error
+
+def ground_crossing(y0, y1, dy0, dy1):
+    # Bisect the cubic Hermite interpolant through (y0, dy0) and (y1, dy1) on [0, 1] for its root
+    low, high = 0.0, 1.0
+    for _ in range(50):
+        s = 0.5 * (low + high)
+        h00 = 2 * s ** 3 - 3 * s ** 2 + 1
+        h10 = s ** 3 - 2 * s ** 2 + s
+        h01 = -2 * s ** 3 + 3 * s ** 2
+        h11 = s ** 3 - s ** 2
+        if h00 * y0 + h10 * dy0 + h01 * y1 + h11 * dy1 >= 0:
+            low = s
+        else:
+            high = s
+    return low
+
+def simulate_trajectory(bullet, planet, angle, time_step, method='euler', rtol=1e-6, atol=1e-6):
     # Convert angle from degrees to radians
     angle = np.deg2rad(angle)
-
-    # Initialize arrays to store position, velocity, and acceleration
-    position = np.zeros((1, 2))
-    velocity = np.zeros((1, 2))
+    acceleration = acceleration_function(bullet, planet)
 
     # Set initial conditions
-    position[0, :] = [0, 0]
-    velocity[0, :] = [bullet.initial_velocity * np.cos(angle), bullet.initial_velocity * np.sin(angle)]
+    x, y = 0.0, 0.0
+    vx, vy = bullet.initial_velocity * np.cos(angle), bullet.initial_velocity * np.sin(angle)
+    trajectory = TrajectoryBuffer()
+    trajectory.append(x, y, vx, vy)
 
-    # Simulate trajectory
-    i = 0
-    while True:
-        # Calculate gravity and atmospheric density
-        gravity = planet.get_gravity(position[i, 1])
-        atmospheric_density = planet.get_atmospheric_density(position[i, 1])
+    if method == 'euler':
+        # Semi-implicit Euler: the position moves along a straight line with the updated velocity during each step
+        while True:
+            ax, ay = acceleration(y, vx, vy)
+            vx, vy = vx + ax * time_step, vy + ay * time_step
+            new_x, new_y = x + vx * time_step, y + vy * time_step
+
+            # Ground impact: stop exactly where the step crosses the surface
+            if new_y < 0:
+                fraction = y / (y - new_y)
+                trajectory.append(x + fraction * (new_x - x), 0.0, vx, vy)
+                break
+            x, y = new_x, new_y
+            trajectory.append(x, y, vx, vy)
 
-        # Calculate drag force
-        drag_force = 0.5 * atmospheric_density * bullet.frontal_area * bullet.drag_coefficient * np.linalg.norm(velocity[i, :])**2
+    elif method == 'rk45':
+        state = np.array([x, y, vx, vy])
+        h = time_step
+        while True:
+            new_state, error = rk45_step(acceleration, state, h)
+            scale = atol + rtol * np.maximum(np.abs(state), np.abs(new_state))
+            error_norm = np.sqrt(np.mean((error / scale) ** 2))
+            if error_norm > 1:
+                h *= max(0.2, 0.9 * error_norm ** -0.2)
+                continue
 
-        # Calculate acceleration
-        acceleration = np.array([-drag_force * velocity[i, 0] / (bullet.mass * np.linalg.norm(velocity[i, :])), -gravity - drag_force * velocity[i, 1] / (bullet.mass * np.linalg.norm(velocity[i, :]))])
+            # Ground impact: find the crossing on the cubic Hermite interpolant of the altitude over the step
+            if new_state[1] < 0:
+                fraction = ground_crossing(state[1], new_state[1], state[3] * h, new_state[3] * h)
+                impact = state + fraction * (new_state - state)
+                impact[1] = 0.0
+                trajectory.append(*impact)
+                break
+            state = new_state
+            trajectory.append(*state)
+            h *= min(5.0, 0.9 * max(error_norm, 1e-10) ** -0.2)
 
-        # Update velocity and position
-        velocity = np.vstack((velocity, velocity[i, :] + acceleration * time_step))
-        position = np.vstack((position, position[i, :] + velocity[i + 1, :] * time_step))
+    else:
+        raise ValueError("Unknown integration method: {}".format(method))
 
-        # Check if bullet has hit the ground
-        if position[i + 1, 1] < 0:
-            break
+    return trajectory.to_arrays()
 
-        i += 1
+def simulate_batch(cases, time_step):
+    # Advance every (angle, bullet, planet) case in lock step with the semi-implicit Euler update of
+    # simulate_trajectory, dropping each case from the active set once it lands
+    count = len(cases)
+    results = {
+        'range': np.zeros(count),
+        'apex': np.zeros(count),
+        'time_of_flight': np.zeros(count),
+        'impact_speed': np.zeros(count)
+    }
+    if not count:
+        return results
+
+    angles = np.deg2rad([angle for angle, bullet, planet in cases])
+    speeds = np.array([bullet.initial_velocity for angle, bullet, planet in cases], dtype=np.float64)
+    drag_factors = np.array([0.5 * bullet.frontal_area * bullet.drag_coefficient / bullet.mass for angle, bullet, planet in cases])
+    gravitational_parameters = np.array([G * planet.mass for angle, bullet, planet in cases])
+    radii = np.array([planet.radius for angle, bullet, planet in cases], dtype=np.float64)
+
+    # One flat density table for all planets, addressed by a per-case offset
+    planets = list({id(planet): planet for angle, bullet, planet in cases}.values())
+    table = np.concatenate([planet.density_table for planet in planets])
+    starts = np.cumsum([0] + [len(planet.density_table) for planet in planets])[:-1]
+    planet_index = {id(planet): i for i, planet in enumerate(planets)}
+    which = np.array([planet_index[id(planet)] for angle, bullet, planet in cases], dtype=np.int64)
+    lowest = np.array([planet.min_altitude for planet in planets], dtype=np.float64)[which]
+    highest = np.array([planet.max_altitude for planet in planets], dtype=np.float64)[which]
+    steps = np.array([planet.density_step for planet in planets])[which]
+    base = starts[which]
+    last = np.array([len(planet.density_table) - 2 for planet in planets])[which]
+
+    x, y = np.zeros(count), np.zeros(count)
+    vx, vy = speeds * np.cos(angles), speeds * np.sin(angles)
+    apex = np.zeros(count)
+
+    active = np.arange(count)
+    step = 0
+    while len(active) > SCALAR_TAIL:
+        gravity = gravitational_parameters[active] / (radii[active] + y) ** 2
+        offset = (np.clip(y, lowest[active], highest[active]) - lowest[active]) / steps[active]
+        i = np.minimum(offset.astype(np.int64), last[active])
+        lower = table[base[active] + i]
+        atmospheric_density = lower + (offset - i) * (table[base[active] + i + 1] - lower)
+        drag = drag_factors[active] * atmospheric_density * np.sqrt(vx * vx + vy * vy)
+
+        vx = vx - drag * vx * time_step
+        vy = vy + (-gravity - drag * vy) * time_step
+        new_x, new_y = x + vx * time_step, y + vy * time_step
+        step += 1
+
+        # Ground impact: cut the step where it crosses the surface
+        landed = new_y < 0
+        if landed.any():
+            fraction = y[landed] / (y[landed] - new_y[landed])
+            cases_landed = active[landed]
+            results['range'][cases_landed] = x[landed] + fraction * (new_x[landed] - x[landed])
+            results['apex'][cases_landed] = apex[landed]
+            results['time_of_flight'][cases_landed] = (step - 1 + fraction) * time_step
+            results['impact_speed'][cases_landed] = np.sqrt(vx[landed] ** 2 + vy[landed] ** 2)
 
-    return position, velocity
+            flying = ~landed
+            active, x, y, vx, vy, apex = active[flying], new_x[flying], new_y[flying], vx[flying], vy[flying], apex[flying]
+        else:
+            x, y = new_x, new_y
+        np.maximum(apex, y, out=apex)
+
+    # Finish the few long flights one at a time, the per-step array overhead no longer pays off
+    for k, case in enumerate(active):
+        angle, bullet, planet = cases[case]
+        acceleration = acceleration_function(bullet, planet)
+        case_x, case_y, case_vx, case_vy, case_apex, case_step = x[k], y[k], vx[k], vy[k], apex[k], step
+        while True:
+            ax, ay = acceleration(case_y, case_vx, case_vy)
+            case_vx, case_vy = case_vx + ax * time_step, case_vy + ay * time_step
+            new_x, new_y = case_x + case_vx * time_step, case_y + case_vy * time_step
+            case_step += 1
+            if new_y < 0:
+                fraction = case_y / (case_y - new_y)
+                results['range'][case] = case_x + fraction * (new_x - case_x)
+                results['apex'][case] = case_apex
+                results['time_of_flight'][case] = (case_step - 1 + fraction) * time_step
+                results['impact_speed'][case] = math.sqrt(case_vx * case_vx + case_vy * case_vy)
+                break
+            case_x, case_y = new_x, new_y
+            case_apex = max(case_apex, case_y)
+
+    return results
+
+def firing_table(bullets, planets, angles, time_step):
+    # Range, apex and time of flight for every bullet, planet and angle, from one batched solve
+    cases = [(angle, bullet, planet) for bullet in bullets for planet in planets for angle in angles]
+    results = simulate_batch(cases, time_step)
+    return [[bullet.name, planet.name, angle, results['range'][i], results['apex'][i], results['time_of_flight'][i]]
+            for i, (angle, bullet, planet) in enumerate(cases)]
+
+FIRING_TABLE_HEADERS = ['Bullet', 'Planet', 'Angle (deg)', 'Range (m)', 'Apex (m)', 'Time of Flight (s)']
+
+def optimal_angle(bullet, planet, time_step, low=0.0, high=90.0, samples=91, tolerance=0.01):
+    # Maximum-range angle: solve a batch of angles, then zoom in around the best one until the spacing is below tolerance
+    while True:
+        angles = np.linspace(low, high, samples)
+        ranges = simulate_batch([(angle, bullet, planet) for angle in angles], time_step)['range']
+        best = int(np.argmax(ranges))
+        spacing = angles[1] - angles[0]
+        if spacing <= tolerance:
+            return angles[best], ranges[best]
+        low, high = angles[max(best - 1, 0)], angles[min(best + 1, samples - 1)]
+        samples = 21
 
 def main():
     # Create a Bullet object for an AK-47 bullet
@@ -115,6 +326,12 @@ def main():
     print("Initial Velocity Magnitude: {:.2f} m/s".format(np.linalg.norm(velocity[0, :])))
     print("Final Velocity Magnitude: {:.2f} m/s".format(np.linalg.norm(velocity[-1, :])))
 
+    # Firing table and maximum-range angle from the batched solver
+    print(tabulate(firing_table([bullet], [planet], [15, 30, 45, 60, 75], time_step), headers=FIRING_TABLE_HEADERS,
+                   tablefmt='simple', floatfmt='.2f'))
+    best_angle, best_range = optimal_angle(bullet, planet, time_step)
+    print("Maximum Range: {:.2f} m at {:.2f} degrees".format(best_range, best_angle))
+
     # Plot trajectory
     plt.figure(figsize=(10, 6))
     plt.plot(position[:, 0], position[:, 1])
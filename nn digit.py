@@ -1,3 +1,5 @@
+import time
+
 import numpy as np
 from sklearn.datasets import load_digits
 from sklearn.model_selection import train_test_split
@@ -6,160 +8,373 @@ import matplotlib.pyplot as plt
 
 # Sigmoid function
 def sigmoid(x):
-    return 1 / (1 + np.exp(-x))
+    return 1 / (1 + np.exp(-x))
 
 # Derivative of sigmoid function
 def sigmoid_derivative(x):
-    return x * (1 - x)
+    return x * (1 - x)
 
 # Softmax function
 def softmax(x):
-    x_max = np.max(x, axis=1, keepdims=True)
-    x_exp = np.exp(x - x_max)
-    return x_exp / np.sum(x_exp, axis=1, keepdims=True)
+    x_max = np.max(x, axis=1, keepdims=True)
+    x_exp = np.exp(x - x_max)
+    return x_exp / np.sum(x_exp, axis=1, keepdims=True)
 
 class NeuralNet:
-    def __init__(self, input_size, hidden1_size, hidden2_size, output_size):
-        """
-        Initialize the neural network with the given layer sizes.
-
-        Parameters:
-        input_size (int): The number of neurons in the input layer.
-        hidden1_size (int): The number of neurons in the first hidden layer.
-        hidden2_size (int): The number of neurons in the second hidden layer.
-        output_size (int): The number of neurons in the output layer.
-        """
-        self.weights1 = np.random.rand(input_size, hidden1_size)
-        self.weights2 = np.random.rand(hidden1_size, hidden2_size)
-        self.weights3 = np.random.rand(hidden2_size, output_size)
-
-        self.mean1 = np.zeros((hidden1_size,))
-        self.std1 = np.ones((hidden1_size,))
-        self.mean2 = np.zeros((hidden2_size,))
-        self.std2 = np.ones((hidden2_size,))
-
-        self.beta1 = 0.9
-        self.beta2 = 0.999
-        self.epsilon = 1e-8
-        self.m1 = np.zeros((input_size, hidden1_size))
-        self.v1 = np.zeros((input_size, hidden1_size))
-        self.m2 = np.zeros((hidden1_size, hidden2_size))
-        self.v2 = np.zeros((hidden1_size, hidden2_size))
-        self.m3 = np.zeros((hidden2_size, output_size))
-        self.v3 = np.zeros((hidden2_size, output_size))
-
-    def forward(self, X):
-        """
-        Perform a forward pass through the neural network.
-
-        Parameters:
-        X (numpy array): The input to the neural network.
-
-        Returns:
-        numpy array: The output of the neural network.
-        """
-        self.layer1 = sigmoid(self.batch_normalize(np.dot(X, self.weights1), self.mean1, self.std1))
-        self.layer2 = sigmoid(self.batch_normalize(np.dot(self.layer1, self.weights2), self.mean2, self.std2))
-        self.output = softmax(np.dot(self.layer2, self.weights3))
-        return self.output
-
-    def backward(self, X, y, output):
-        """
-        Perform a backward pass through the neural network to compute the gradients.
-
-        Parameters:
-        X (numpy array): The input to the neural network.
-        y (numpy array): The true labels.
-        output (numpy array): The predicted labels.
-
-        Returns:
-        numpy array, numpy array, numpy array: The gradients of the loss with respect to the weights.
-        """
-        d_output = 2 * (output - y)
-        d_weights3 = np.dot(self.layer2.T, d_output)
-        d_layer2 = np.dot(d_output, self.weights3.T) * sigmoid_derivative(self.layer2)
-        d_weights2 = np.dot(self.layer1.T, d_layer2)
-        d_layer1 = np.dot(d_layer2, self.weights2.T) * sigmoid_derivative(self.layer1)
-        d_weights1 = np.dot(X.T, d_layer1)
-
-        return d_weights1, d_weights2, d_weights3
-
-    def update_weights(self, d_weights1, d_weights2, d_weights3, learning_rate, t):
-        """
-        Update the weights of the neural network using the gradients and the learning rate.
-
-        Parameters:
-        d_weights1 (numpy array): The gradient of the loss with respect to the first set of weights.
-        d_weights2 (numpy array): The gradient of the loss with respect to the second set of weights.
-        d_weights3 (numpy array): The gradient of the loss with respect to the third set of weights.
-        learning_rate (float): The learning rate of the neural network.
-        t (int): The current iteration.
-        """
-        self.m1 = self.beta1 * self.m1 + (1 - self.beta1) * d_weights1
-        self.v1 = self.beta2 * self.v1 + (1 - self.beta2) * d_weights1 ** 2
-        self.weights1 -= learning_rate * self.m1 / (np.sqrt(self.v1) + self.epsilon)
-
-        self.m2 = self.beta1 * self.m2 + (1 - self.beta1) * d_weights2
-        self.v2 = self.beta2 * self.v2 + (1 - self.beta2) * d_weights2 ** 2
-        self.weights2 -= learning_rate * self.m2 / (np.sqrt(self.v2) + self.epsilon)
-
-        self.m3 = self.beta1 * self.m3 + (1 - self.beta1) * d_weights3
-        self.v3 = self.beta2 * self.v3 + (1 - self.beta2) * d_weights3 ** 2
-        self.weights3 -= learning_rate * self.m3 / (np.sqrt(self.v3) + self.epsilon)
-
-    def batch_normalize(self, x, mean, std):
-        """
-        Normalize the input to a layer using batch normalization.
-
-        Parameters:
-        x (numpy array): The input to the layer.
-        mean (numpy array): The mean of the input.
-        std (numpy array): The standard deviation of the input.
-
-        Returns:
-        numpy array: The normalized input.
-        """
-        mean = 0.9 * mean + 0.1 * np.mean(x, axis=0)
-        std = 0.9 * std + 0.1 * np.std(x, axis=0)
-        return (x - mean) / (std + 1e-8)
+    def __init__(self, input_size, hidden1_size, hidden2_size, output_size, dtype=np.float32):
+        """
+        Initialize the neural network with the given layer sizes.
+
+        Parameters:
+        input_size (int): The number of neurons in the input layer.
+        hidden1_size (int): The number of neurons in the first hidden layer.
+        hidden2_size (int): The number of neurons in the second hidden layer.
+        output_size (int): The number of neurons in the output layer.
+        dtype (numpy dtype): The dtype of the weights and optimizer state.
+        """
+        self.dtype = dtype
+        self.weights1 = np.random.rand(input_size, hidden1_size).astype(dtype)
+        self.weights2 = np.random.rand(hidden1_size, hidden2_size).astype(dtype)
+        self.weights3 = np.random.rand(hidden2_size, output_size).astype(dtype)
+
+        self.mean1 = np.zeros((hidden1_size,), dtype=dtype)
+        self.std1 = np.ones((hidden1_size,), dtype=dtype)
+        self.mean2 = np.zeros((hidden2_size,), dtype=dtype)
+        self.std2 = np.ones((hidden2_size,), dtype=dtype)
+
+        self.beta1 = 0.9
+        self.beta2 = 0.999
+        self.epsilon = 1e-8
+        self.m1 = np.zeros_like(self.weights1)
+        self.v1 = np.zeros_like(self.weights1)
+        self.m2 = np.zeros_like(self.weights2)
+        self.v2 = np.zeros_like(self.weights2)
+        self.m3 = np.zeros_like(self.weights3)
+        self.v3 = np.zeros_like(self.weights3)
+        self.scratch = [np.zeros_like(self.weights1), np.zeros_like(self.weights2), np.zeros_like(self.weights3)]
+
+    def forward(self, X):
+        """
+        Perform a forward pass through the neural network.
+
+        Parameters:
+        X (numpy array): The input to the neural network.
+
+        Returns:
+        numpy array: The output of the neural network.
+        """
+        self.layer1 = sigmoid(self.batch_normalize(np.dot(X, self.weights1), self.mean1, self.std1))
+        self.layer2 = sigmoid(self.batch_normalize(np.dot(self.layer1, self.weights2), self.mean2, self.std2))
+        self.output = softmax(np.dot(self.layer2, self.weights3))
+        return self.output
+
+    def backward(self, X, y, output):
+        """
+        Perform a backward pass through the neural network to compute the gradients.
+
+        Parameters:
+        X (numpy array): The input to the neural network.
+        y (numpy array): The true labels.
+        output (numpy array): The predicted labels.
+
+        Returns:
+        numpy array, numpy array, numpy array: The gradients of the loss with respect to the weights.
+        """
+        d_output = 2 * (output - y)
+        d_weights3 = np.dot(self.layer2.T, d_output)
+        d_layer2 = np.dot(d_output, self.weights3.T) * sigmoid_derivative(self.layer2)
+        d_weights2 = np.dot(self.layer1.T, d_layer2)
+        d_layer1 = np.dot(d_layer2, self.weights2.T) * sigmoid_derivative(self.layer1)
+        d_weights1 = np.dot(X.T, d_layer1)
+
+        return d_weights1, d_weights2, d_weights3
+
+    def update_weights(self, d_weights1, d_weights2, d_weights3, learning_rate, t):
+        """
+        Update the weights of the neural network using the gradients and the learning rate.
+
+        Parameters:
+        d_weights1 (numpy array): The gradient of the loss with respect to the first set of weights.
+        d_weights2 (numpy array): The gradient of the loss with respect to the second set of weights.
+        d_weights3 (numpy array): The gradient of the loss with respect to the third set of weights.
+        learning_rate (float): The learning rate of the neural network.
+        t (int): The current iteration.
+        """
+        layers = ((self.weights1, self.m1, self.v1, d_weights1, self.scratch[0]),
+                  (self.weights2, self.m2, self.v2, d_weights2, self.scratch[1]),
+                  (self.weights3, self.m3, self.v3, d_weights3, self.scratch[2]))
+        for weights, m, v, gradient, scratch in layers:
+            m *= self.beta1
+            np.multiply(gradient, 1 - self.beta1, out=scratch)
+            m += scratch
+            np.square(gradient, out=scratch)
+            scratch *= 1 - self.beta2
+            v *= self.beta2
+            v += scratch
+
+            np.sqrt(v, out=scratch)
+            scratch += self.epsilon
+            np.divide(m, scratch, out=scratch)
+            scratch *= learning_rate
+            weights -= scratch
+
+    def batch_normalize(self, x, mean, std):
+        """
+        Normalize the input to a layer using batch normalization.
+
+        Parameters:
+        x (numpy array): The input to the layer.
+        mean (numpy array): The mean of the input.
+        std (numpy array): The standard deviation of the input.
+
+        Returns:
+        numpy array: The normalized input.
+        """
+        mean = 0.9 * mean + 0.1 * np.mean(x, axis=0)
+        std = 0.9 * std + 0.1 * np.std(x, axis=0)
+        return (x - mean) / (std + 1e-8)
+
+    def predictor(self, X, scaler=None):
+        """
+        Freeze the network into a Predictor for fast inference.
+
+        The normalization statistics the training forward pass applies to X are computed once and folded into the
+        weights and biases, so each hidden layer becomes a single matrix product followed by a sigmoid.
+
+        Parameters:
+        X (numpy array): The training inputs that define the normalization statistics.
+        scaler (StandardScaler): The scaler applied to the raw inputs, folded into the first layer if given.
+
+        Returns:
+        Predictor: The frozen network.
+        """
+        weights, biases = [], []
+        layer = np.asarray(X, dtype=np.float64)
+        for layer_weights, mean, std in ((self.weights1, self.mean1, self.std1), (self.weights2, self.mean2, self.std2)):
+            x = layer @ layer_weights
+            mean = 0.9 * mean + 0.1 * np.mean(x, axis=0)
+            std = 0.9 * std + 0.1 * np.std(x, axis=0) + 1e-8
+            weights.append(layer_weights / std)
+            biases.append(-mean / std)
+            layer = sigmoid(layer @ weights[-1] + biases[-1])
+        weights.append(self.weights3.astype(np.float64))
+        biases.append(np.zeros(self.weights3.shape[1]))
+
+        if scaler is not None:
+            biases[0] = biases[0] - (scaler.mean_ / scaler.scale_) @ weights[0]
+            weights[0] = weights[0] / scaler.scale_[:, None]
+        return Predictor([w.astype(np.float32) for w in weights], [b.astype(np.float32) for b in biases])
+
+    def train(self, X, y, X_val, y_val, learning_rate=0.01, batch_size=64, epochs=200, patience=10, verbose=True):
+        """
+        Train the neural network with shuffled mini-batches and stop early on the validation loss.
+
+        Parameters:
+        X (numpy array): The training inputs.
+        y (numpy array): The one-hot training labels.
+        X_val (numpy array): The validation inputs.
+        y_val (numpy array): The one-hot validation labels.
+        learning_rate (float): The learning rate of the neural network.
+        batch_size (int): The number of samples per weight update.
+        epochs (int): The maximum number of passes over the training data.
+        patience (int): The number of epochs without a better validation loss before training stops.
+        verbose (bool): Whether to print the losses after every epoch.
+
+        Returns:
+        list: The training loss, validation loss and validation accuracy of every epoch.
+        """
+        X, y = X.astype(self.dtype), y.astype(self.dtype)
+        X_val, y_val = X_val.astype(self.dtype), y_val.astype(self.dtype)
+        best_weights = [self.weights1.copy(), self.weights2.copy(), self.weights3.copy()]
+        best_loss = np.inf
+        waited = 0
+        history = []
+        t = 0
+
+        for epoch in range(epochs):
+            order = np.random.permutation(len(X))
+            loss = 0.0
+            for start in range(0, len(X), batch_size):
+                batch = order[start:start + batch_size]
+                output = self.forward(X[batch])
+                loss += np.sum((output - y[batch]) ** 2)
+                t += 1
+                self.update_weights(*self.backward(X[batch], y[batch], output), learning_rate, t)
+
+            val_output = self.forward(X_val)
+            val_loss = float(np.mean((val_output - y_val) ** 2))
+            val_accuracy = float(np.mean(np.argmax(val_output, axis=1) == np.argmax(y_val, axis=1)))
+            history.append({'epoch': epoch, 'loss': float(loss / y.size), 'val_loss': val_loss, 'val_accuracy': val_accuracy})
+            if verbose:
+                print("Epoch: {}, Loss: {}, Validation loss: {}, Validation accuracy: {}".format(
+                    epoch, history[-1]['loss'], val_loss, val_accuracy))
+
+            if val_loss < best_loss:
+                best_loss = val_loss
+                waited = 0
+                for best, weights in zip(best_weights, (self.weights1, self.weights2, self.weights3)):
+                    np.copyto(best, weights)
+            else:
+                waited += 1
+                if waited >= patience:
+                    break
+
+        for best, weights in zip(best_weights, (self.weights1, self.weights2, self.weights3)):
+            np.copyto(weights, best)
+        return history
+
+class Predictor:
+    def __init__(self, weights, biases):
+        """
+        Initialize an inference-only network from fused layer weights.
+
+        Parameters:
+        weights (list): The float32 weight matrix of each layer, with normalization folded in.
+        biases (list): The float32 bias vector of each layer.
+        """
+        self.weights = weights
+        self.biases = biases
+
+        # sigmoid(z) = 0.5 * tanh(z / 2) + 0.5, with the halving and the affine part folded into the adjacent layers
+        self.layers = []
+        input_scale, input_shift = np.float32(1), None
+        for i, (layer_weights, bias) in enumerate(zip(weights, biases)):
+            layer_weights = layer_weights * input_scale
+            if input_shift is not None:
+                bias = bias + input_shift @ layer_weights / input_scale
+            if i < len(weights) - 1:
+                layer_weights, bias = layer_weights / 2, bias / 2
+            self.layers.append((layer_weights.astype(np.float32), bias.astype(np.float32)))
+            input_scale = np.float32(0.5)
+            input_shift = np.full(layer_weights.shape[1], 0.5, dtype=np.float32)
+
+    def logits(self, X):
+        """
+        Compute the output layer before the softmax without modifying the predictor.
+
+        Parameters:
+        X (numpy array): The input to the network.
+
+        Returns:
+        numpy array: The output logits.
+        """
+        layer = np.asarray(X, dtype=np.float32)
+        for weights, bias in self.layers[:-1]:
+            layer = layer @ weights
+            layer += bias
+            np.tanh(layer, out=layer)
+        weights, bias = self.layers[-1]
+        return layer @ weights + bias
+
+    def predict_proba(self, X):
+        """
+        Compute the class probabilities for the given inputs.
+
+        Parameters:
+        X (numpy array): The input to the network.
+
+        Returns:
+        numpy array: The softmax probabilities.
+        """
+        return softmax(self.logits(X))
+
+    def predict(self, X):
+        """
+        Predict the class of each input.
+
+        Parameters:
+        X (numpy array): The input to the network.
+
+        Returns:
+        numpy array: The predicted class labels.
+        """
+        return np.argmax(self.logits(X), axis=1)
+
+    def save(self, path, quantize=False):
+        """
+        Save the predictor to a .npz file.
+
+        Parameters:
+        path (str): The file to write.
+        quantize (bool): Whether to store the weights as int8 with one float32 scale per output neuron.
+        """
+        arrays = {}
+        for i, (weights, bias) in enumerate(zip(self.weights, self.biases)):
+            arrays['bias{}'.format(i)] = bias
+            if quantize:
+                scale = np.abs(weights).max(axis=0) / 127
+                scale[scale == 0] = 1
+                arrays['weights{}'.format(i)] = np.round(weights / scale).astype(np.int8)
+                arrays['scale{}'.format(i)] = scale.astype(np.float32)
+            else:
+                arrays['weights{}'.format(i)] = weights
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a predictor saved with save().
+
+        Parameters:
+        path (str): The .npz file to read.
+
+        Returns:
+        Predictor: The loaded predictor, with int8 weights dequantized to float32.
+        """
+        with np.load(path) as arrays:
+            weights, biases = [], []
+            for i in range(sum(name.startswith('bias') for name in arrays.files)):
+                layer = arrays['weights{}'.format(i)].astype(np.float32)
+                if 'scale{}'.format(i) in arrays.files:
+                    layer *= arrays['scale{}'.format(i)]
+                weights.append(layer)
+                biases.append(arrays['bias{}'.format(i)])
+        return cls(weights, biases)
 
 # Load MNIST dataset
 digits = load_digits()
 X = digits.data
 y = np.zeros((len(digits.target), 10))
 for i, target in enumerate(digits.target):
-    y[i, target] = 1
+    y[i, target] = 1
 
-# Split data into training and testing sets
+# Split data into training, validation and testing sets
 X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
+X_train, X_val, y_train, y_val = train_test_split(X_train, y_train, test_size=0.1, random_state=42)
 
 # Standardize data
 scaler = StandardScaler()
-X_train = scaler.fit_transform(X_train)
-X_test = scaler.transform(X_test)
+X_train = scaler.fit_transform(X_train).astype(np.float32)
+X_val = scaler.transform(X_val).astype(np.float32)
+X_test = scaler.transform(X_test).astype(np.float32)
 
 # Initialize neural network
 nn = NeuralNet(64, 256, 128, 10)
 
 # Train neural network
 learning_rate = 0.01
-for epoch in range(10000):
-    output = nn.forward(X_train)
-    d_weights1, d_weights2, d_weights3 = nn.backward(X_train, y_train, output)
-    nn.update_weights(d_weights1, d_weights2, d_weights3, learning_rate, epoch + 1)
-    if epoch % 100 == 0:
-        print("Epoch: {}, Loss: {}".format(epoch, np.mean((output - y_train) ** 2)))
+start = time.perf_counter()
+history = nn.train(X_train, y_train, X_val, y_val, learning_rate)
+print("Trained {} epochs in {:.1f}s".format(len(history), time.perf_counter() - start))
+
+# Freeze the trained network and export it
+predictor = nn.predictor(X_train)
+predictor.save('digits_model.npz', quantize=True)
+predictor = Predictor.load('digits_model.npz')
 
 # Test neural network
-output = nn.forward(X_test)
+output = predictor.predict_proba(X_test)
 print("Test accuracy: {}".format(np.mean(np.argmax(output, axis=1) == np.argmax(y_test, axis=1))))
+start = time.perf_counter()
+predictor.predict(X_test)
+print("Predictions per millisecond: {:.0f}".format(len(X_test) / ((time.perf_counter() - start) * 1000)))
 
 # Plot example digits
 fig, axes = plt.subplots(2, 5, figsize=(15, 6))
 for i in range(10):
-    ax = axes[i // 5, i % 5]
-    ax.imshow(digits.images[i], cmap='gray')
-    ax.set_title("Digit: {}".format(digits.target[i]))
+    ax = axes[i // 5, i % 5]
+    ax.imshow(digits.images[i], cmap='gray')
+    ax.set_title("Digit: {}".format(digits.target[i]))
 plt.tight_layout()
 plt.show()
 
@@ -168,7 +383,7 @@ predicted_labels = np.argmax(output, axis=1)
 actual_labels = np.argmax(y_test, axis=1)
 confusion_matrix = np.zeros((10, 10))
 for i in range(len(predicted_labels)):
-    confusion_matrix[actual_labels[i], predicted_labels[i]] += 1
+    confusion_matrix[actual_labels[i], predicted_labels[i]] += 1
 
 plt.figure(figsize=(10, 8))
 plt.imshow(confusion_matrix, cmap='Blues')
@@ -1,82 +1,397 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+
 import numpy as np
-import numba as nb
-from numba import njit, prange
 
-N_s = 32  # Spatial extent
-N_t = 64  # Temporal extent
+# this script is itself called numba.py, so keep its directory off the path while importing the real package
+_here = os.path.dirname(os.path.abspath(__file__))
+_saved_path = sys.path[:]
+sys.path[:] = [entry for entry in sys.path if os.path.abspath(entry or os.curdir) != _here]
+try:
+    import numba as nb
+    from numba import njit, prange
+finally:
+    sys.path[:] = _saved_path
+
+N_s = 32  # Spatial extent
+N_t = 64  # Temporal extent
 
-beta = 6.0  # Gauge coupling
+beta = 6.0  # Gauge coupling
 
 
-@njit(fastmath=True)
+@njit(fastmath=True, cache=True)
 def lattice_spacing(beta):
-    a = 0.1 / beta
-    return a
+    a = 0.1 / beta
+    return a
 
 a = lattice_spacing(beta)
 
 
-@njit(fastmath=True)
-def clover_action(gauge_field, beta, a, N_s, N_t):
-    action = 0
-    for t in prange(N_t):
-        for x in prange(N_s):
-            for y in prange(N_s):
-                for z in prange(N_s):
-                    for j in prange(3):
-                        for k in prange(3):
-                            staple = np.exp(1j * (gauge_field[t, x, y, z, j, k] - gauge_field[t, x, y, z, k, j]))
-                            action += beta * (1 - np.real(staple))
-    return action
-
-
-gauge_field = np.zeros((N_t, N_s, N_s, N_s, 3, 3), dtype=np.complex128)
-
-@njit(fastmath=True, parallel=True)
-def hmc(gauge_field, beta, a, N_s, N_t, n_steps, max_iterations):
-    force = np.zeros((N_t, N_s, N_s, N_s, 3, 3), dtype=np.complex128)
-    iteration = 0
-    while iteration < max_iterations:
-        for i in prange(n_steps):
-            for t in prange(N_t):
-                for x in prange(N_s):
-                    for y in prange(N_s):
-                        for z in prange(N_s):
-                            for j in prange(3):
-                                for k in prange(3):
-                                    staple = np.exp(1j * (gauge_field[t, x, y, z, j, k] - gauge_field[t, x, y, z, k, j]))
-                                    force[t, x, y, z, j, k] = -beta * np.imag(staple)
-           
-            gauge_field += a * force
-       
-        iteration += 1
-   
-    return gauge_field
-
-
-n_steps = 10
-max_iterations = 1000
-gauge_field = hmc(gauge_field, beta, a, N_s, N_t, n_steps, max_iterations)
-
-
-@njit(fastmath=True, parallel=True)
+def new_gauge_field(N_s, N_t, dtype=np.complex128):
+    return np.zeros((N_t, N_s, N_s, N_s, 3, 3), dtype=dtype)
+
+
+@njit(fastmath=True, parallel=True, cache=True)
+def clover_action(gauge_field, beta):
+    N_t, N_s = gauge_field.shape[0], gauge_field.shape[1]
+    partial = np.zeros(N_t)
+    for t in prange(N_t):
+        action = 0.0
+        for x in range(N_s):
+            for y in range(N_s):
+                for z in range(N_s):
+                    for j in range(3):
+                        for k in range(3):
+                            d = gauge_field[t, x, y, z, j, k] - gauge_field[t, x, y, z, k, j]
+                            # Re exp(i d) without promoting complex64 links to complex128
+                            action += beta * (1 - np.exp(-d.imag) * np.cos(d.real))
+        partial[t] = action
+    return partial.sum()
+
+
+@njit(fastmath=True, parallel=True, cache=True)
+def hmc(gauge_field, beta, a, n_steps, max_iterations):
+    N_t, N_s = gauge_field.shape[0], gauge_field.shape[1]
+    for iteration in range(max_iterations):
+        for i in range(n_steps):
+            # the force on a link only depends on its own site, so each step is applied in place
+            for t in prange(N_t):
+                for x in range(N_s):
+                    for y in range(N_s):
+                        for z in range(N_s):
+                            for j in range(3):
+                                for k in range(j + 1, 3):
+                                    d = gauge_field[t, x, y, z, j, k] - gauge_field[t, x, y, z, k, j]
+                                    sine = np.sin(d.real)
+                                    gauge_field[t, x, y, z, j, k] += a * -beta * np.exp(-d.imag) * sine
+                                    gauge_field[t, x, y, z, k, j] += a * beta * np.exp(d.imag) * sine
+    return gauge_field
+
+
+@njit(fastmath=True, parallel=True, cache=True)
 def plaquette(gauge_field):
-    plaquette = 0
-    for t in prange(N_t):
-        for x in prange(N_s):
-            for y in prange(N_s):
-                for z in prange(N_s):
-                    for j in prange(3):
-                        for k in prange(3):
-                            plaquette += np.real(gauge_field[t, x, y, z, j, k] * gauge_field[t, x, y, z, j, k].conj())
-    return plaquette / (N_t * N_s ** 3 * 6)
+    N_t, N_s = gauge_field.shape[0], gauge_field.shape[1]
+    partial = np.zeros(N_t)
+    for t in prange(N_t):
+        total = 0.0
+        for x in range(N_s):
+            for y in range(N_s):
+                for z in range(N_s):
+                    for j in range(3):
+                        for k in range(3):
+                            link = gauge_field[t, x, y, z, j, k]
+                            total += link.real * link.real + link.imag * link.imag
+        partial[t] = total
+    return partial.sum() / (N_t * N_s ** 3 * 6)
+
+
+class EnsembleWriter:
+    def __init__(self, path, capacity, shape, dtype=np.complex128, beta=beta):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.beta = beta
+        self.configs = np.lib.format.open_memmap(os.path.join(path, 'configs.npy'), mode='w+', dtype=dtype,
+                                                 shape=(capacity,) + tuple(shape))
+        self.metadata = []
+
+    def __len__(self):
+        return len(self.metadata)
+
+    def append(self, gauge_field, **metadata):
+        index = len(self.metadata)
+        if index == len(self.configs):
+            raise IndexError(f"Ensemble {self.path} is full ({index} configurations)")
+        self.configs[index] = gauge_field
+        self.configs.flush()
+        self.metadata.append(dict(metadata, index=index, beta=self.beta, plaquette=float(plaquette(gauge_field))))
+        self.write_metadata()
+        return self.metadata[-1]
+
+    def write_metadata(self):
+        # configs.npy is preallocated, so the metadata decides how many configurations are valid
+        metadata_path = os.path.join(self.path, 'metadata.json')
+        with open(metadata_path + '.tmp', 'w') as metadata_file:
+            json.dump({'count': len(self.metadata), 'configs': self.metadata}, metadata_file, indent=2)
+        os.replace(metadata_path + '.tmp', metadata_path)
+
+    def close(self):
+        self.configs.flush()
+        del self.configs
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class EnsembleReader:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'metadata.json')) as metadata_file:
+            self.metadata = json.load(metadata_file)['configs']
+        self.configs = np.load(os.path.join(path, 'configs.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.metadata)
+
+    def __getitem__(self, index):
+        return self.configs[:len(self)][index]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.metadata[index], self.configs[index]
+
+
+OBSERVABLES = {}
+
+def register_observable(name):
+    def register(function):
+        OBSERVABLES[name] = function
+        return function
+    return register
+
+
+@register_observable('plaquette')
+def measure_plaquette(gauge_field, beta):
+    return plaquette(gauge_field)
+
+
+@register_observable('action')
+def measure_action(gauge_field, beta):
+    return clover_action(gauge_field, beta)
+
+
+def autocorrelation(series):
+    n = len(series)
+    centered = series - series.mean()
+    spectrum = np.fft.rfft(centered, 2 * n)
+    correlation = np.fft.irfft(spectrum * spectrum.conj())[:n]
+    return correlation / correlation[0]
+
+
+def integrated_autocorrelation_time(series, window_factor=6):
+    if len(series) < 2 or np.ptp(series) == 0:
+        return 0.5
+    tau = 0.5 + np.cumsum(autocorrelation(series)[1:])
+    # Madras-Sokal: stop summing at the first window W >= c * tau(W)
+    windows = np.arange(1, len(tau) + 1)
+    stop = np.flatnonzero(windows >= window_factor * tau)
+    return float(tau[stop[0]] if len(stop) else tau[-1])
+
+
+def binned_errors(series, min_bins=4):
+    errors = {}
+    size = 1
+    while len(series) // size >= min_bins:
+        bins = series[:len(series) // size * size].reshape(-1, size).mean(axis=1)
+        errors[size] = float(bins.std(ddof=1) / np.sqrt(len(bins)))
+        size *= 2
+    return errors
+
+
+def summarize(series):
+    series = np.asarray(series, dtype=np.float64)
+    tau = integrated_autocorrelation_time(series)
+    naive = series.std(ddof=1) / np.sqrt(len(series)) if len(series) > 1 else 0.0
+    return {
+        'count': len(series),
+        'mean': float(series.mean()),
+        'error': float(naive * np.sqrt(2 * tau)),
+        'tau_int': tau,
+        'binned_errors': binned_errors(series)
+    }
+
+
+def measure_ensemble(path, tasks, beta, names):
+    configs = None
+    series = {name: [] for name in names}
+    with open(os.path.join(path, 'measurements.jsonl'), 'w') as output_file:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            index, metadata = task
+            if configs is None:
+                configs = np.load(os.path.join(path, 'configs.npy'), mmap_mode='r')
+
+            gauge_field = np.asarray(configs[index])
+            row = {'index': index, 'steps': metadata.get('steps')}
+            for name in names:
+                row[name] = float(OBSERVABLES[name](gauge_field, beta))
+                series[name].append(row[name])
+            output_file.write(json.dumps(row) + '\n')
+            output_file.flush()
+
+    statistics = {name: summarize(values) for name, values in series.items() if values}
+    with open(os.path.join(path, 'statistics.json'), 'w') as statistics_file:
+        json.dump(statistics, statistics_file, indent=2)
+
+
+class MeasurementWorker:
+    # started before any parallel kernel runs so the forked worker gets a clean threading layer
+    def __init__(self, path, beta, observables=None):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.tasks = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=measure_ensemble, daemon=True,
+                                               args=(path, self.tasks, beta, list(observables or OBSERVABLES)))
+        self.process.start()
+
+    def submit(self, index, metadata):
+        if not self.process.is_alive():
+            raise RuntimeError(f"Measurement worker exited with code {self.process.exitcode}")
+        self.tasks.put((index, metadata))
+
+    def statistics(self):
+        with open(os.path.join(self.path, 'statistics.json')) as statistics_file:
+            return json.load(statistics_file)
+
+    def close(self):
+        self.tasks.put(None)
+        self.process.join()
+        if self.process.exitcode != 0:
+            raise RuntimeError(f"Measurement worker exited with code {self.process.exitcode}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def lattice_size(text):
+    N_t, N_s = (int(extent) for extent in text.lower().split('x'))
+    return N_t, N_s
+
+
+def time_call(kernel, *args):
+    start = time.perf_counter()
+    kernel(*args)
+    return time.perf_counter() - start
+
+
+def compile_kernels(dtype, beta, a):
+    # a one-site lattice makes the first call pure JIT compile (or cache load) time
+    gauge_field = new_gauge_field(1, 1, dtype)
+    kernels = {
+        'clover_action': (clover_action, (gauge_field, beta)),
+        'hmc': (hmc, (gauge_field, beta, a, 1, 1)),
+        'plaquette': (plaquette, (gauge_field,))
+    }
+    return {name: {'seconds': time_call(kernel, *args), 'cache_hits': sum(kernel.stats.cache_hits.values())}
+            for name, (kernel, args) in kernels.items()}
+
+
+def benchmark_kernels(N_s, N_t, dtype, beta, a, n_steps, repeats):
+    rng = np.random.default_rng(0)
+    gauge_field = (0.1 * (rng.normal(size=(N_t, N_s, N_s, N_s, 3, 3)) + 1j * rng.normal(size=(N_t, N_s, N_s, N_s, 3, 3)))).astype(dtype)
+    sites = N_t * N_s ** 3
+    kernels = {
+        'clover_action': (clover_action, (gauge_field, beta), 1, gauge_field.nbytes),
+        'hmc': (hmc, (gauge_field, beta, a, n_steps, 1), n_steps, 2 * gauge_field.nbytes * n_steps),
+        'plaquette': (plaquette, (gauge_field,), 1, gauge_field.nbytes)
+    }
+
+    results = {}
+    for name, (kernel, args, sweeps, traffic) in kernels.items():
+        seconds = min(time_call(kernel, *args) for _ in range(repeats))
+        results[name] = {
+            'seconds': seconds,
+            'site_updates_per_second': sites * sweeps / seconds,
+            'bandwidth_gb_per_second': traffic / seconds / 1e9
+        }
+    return results
+
+
+def run_benchmark(sizes, thread_counts, dtype, beta, n_steps, repeats, output_file='lattice_benchmark.json'):
+    a = lattice_spacing(beta)
+    results = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'settings': {
+            'dtype': np.dtype(dtype).name,
+            'beta': beta,
+            'steps': n_steps,
+            'repeats': repeats,
+            'max_threads': nb.config.NUMBA_NUM_THREADS,
+            'threading_layer': None
+        },
+        'compile': compile_kernels(dtype, beta, a),
+        'runs': []
+    }
+    results['settings']['threading_layer'] = nb.threading_layer()
+    for name, entry in results['compile'].items():
+        source = 'cache' if entry['cache_hits'] else 'JIT'
+        print(f"{name}: {entry['seconds'] * 1000:.0f}ms compile ({source})")
+
+    for N_t, N_s in sizes:
+        for threads in thread_counts:
+            nb.set_num_threads(threads)
+            kernels = benchmark_kernels(N_s, N_t, dtype, beta, a, n_steps, repeats)
+            results['runs'].append({'N_t': N_t, 'N_s': N_s, 'threads': threads, 'kernels': kernels})
+            summary = ', '.join(f"{name} {entry['site_updates_per_second'] / 1e6:.1f}M sites/s {entry['bandwidth_gb_per_second']:.1f}GB/s"
+                                for name, entry in kernels.items())
+            print(f"{N_t}x{N_s}^3, {threads:3d} threads: {summary}")
+    nb.set_num_threads(nb.config.NUMBA_NUM_THREADS)
+
+    with open(output_file, 'w') as output:
+        json.dump(results, output, indent=2)
+    print(f"Benchmark results saved as {output_file}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a pure gauge ensemble.')
+    parser.add_argument('--spatial', type=int, default=N_s, help='Spatial extent N_s')
+    parser.add_argument('--temporal', type=int, default=N_t, help='Temporal extent N_t')
+    parser.add_argument('--beta', type=float, default=beta, help='Gauge coupling')
+    parser.add_argument('--steps', type=int, default=10, help='Update steps per iteration')
+    parser.add_argument('--iterations', type=int, default=1000, help='Iterations per configuration')
+    parser.add_argument('--configs', type=int, default=10, help='Number of configurations in the ensemble')
+    parser.add_argument('--complex64', action='store_true', help='Store links in single precision')
+    parser.add_argument('--output', default='ensemble', help='Directory for the memory-mapped ensemble')
+    parser.add_argument('--benchmark', action='store_true', help='Time the kernels instead of generating an ensemble')
+    parser.add_argument('--benchmark-sizes', type=lattice_size, nargs='+', default=[(8, 8), (16, 16), (32, 24), (64, 32)],
+                        help='Lattice sizes to sweep as N_txN_s')
+    parser.add_argument('--benchmark-threads', type=int, nargs='+',
+                        help='Thread counts to sweep, up to NUMBA_NUM_THREADS')
+    parser.add_argument('--benchmark-repeats', type=int, default=3, help='Timed calls per kernel, the fastest is kept')
+    parser.add_argument('--benchmark-output', default='lattice_benchmark.json', help='JSON file for the benchmark results')
+    args = parser.parse_args()
+
+    dtype = np.complex64 if args.complex64 else np.complex128
+    if args.benchmark:
+        max_threads = nb.config.NUMBA_NUM_THREADS
+        if args.benchmark_threads and not all(1 <= threads <= max_threads for threads in args.benchmark_threads):
+            parser.error(f"--benchmark-threads must be between 1 and NUMBA_NUM_THREADS ({max_threads})")
+        thread_counts = args.benchmark_threads or sorted({1, 2, 4, 8, 16, 32, 64, max_threads} & set(range(1, max_threads + 1)))
+        run_benchmark(args.benchmark_sizes, thread_counts, dtype, args.beta, args.steps, args.benchmark_repeats,
+                      args.benchmark_output)
+        return
+
+    a = lattice_spacing(args.beta)
+    measurements = MeasurementWorker(args.output, args.beta)
+    gauge_field = new_gauge_field(args.spatial, args.temporal, dtype)
+    print(f"Lattice {args.temporal}x{args.spatial}^3, {dtype.__name__}, {nb.get_num_threads()} threads")
+
+    gauge_field = hmc(gauge_field, args.beta, a, args.steps, args.iterations)
+    print("Plaquette:", plaquette(gauge_field))
+    print("Action:", clover_action(gauge_field, args.beta))
 
-print("Plaquette:", plaquette(gauge_field))
+    with measurements, EnsembleWriter(args.output, args.configs, gauge_field.shape, dtype, args.beta) as ensemble:
+        for i in range(args.configs):
+            gauge_field = hmc(gauge_field, args.beta, a, args.steps, args.iterations)
+            metadata = ensemble.append(gauge_field, steps=(i + 2) * args.steps * args.iterations)
+            measurements.submit(metadata['index'], metadata)
 
+        print("Ensemble size:", len(ensemble))
 
-ensemble = []
-for i in range(n_steps):
-    gauge_field = hmc(gauge_field, beta, a, N_s, N_t, n_steps, max_iterations)
-    ensemble.append(gauge_field)
+    for name, summary in measurements.statistics().items():
+        print(f"{name}: {summary['mean']:.6g} +/- {summary['error']:.2g} (tau_int {summary['tau_int']:.2f})")
 
-print("Ensemble size:", len(ensemble))
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,7 @@
+import argparse
+from functools import partial
+from multiprocessing import Pool, cpu_count
+
 import numpy as np
 from sklearn import datasets
 from sklearn.model_selection import train_test_split
@@ -13,76 +17,161 @@ X_train, X_val, y_train, y_val = train_test_split(X, y, test_size=0.2, random_st
 
 #Define the activation functions
 def sigmoid(x):
-    # Prevent overflow by clipping the input
-    x = np.clip(x, -500, 500)
-    return 1 / (1 + np.exp(-x))
+    # Prevent overflow by clipping the input
+    x = np.clip(x, -500, 500)
+    return 1 / (1 + np.exp(-x))
+
+def sigmoid_inplace(x):
+    np.clip(x, -500, 500, out=x)
+    np.negative(x, out=x)
+    np.exp(x, out=x)
+    x += 1
+    return np.reciprocal(x, out=x)
 
 def softmax(x):
-    x = np.clip(x, -500, 500)
-    return np.exp(x) / np.sum(np.exp(x), axis=1, keepdims=True)
+    x = np.exp(np.clip(x, -500, 500))
+    return x / np.sum(x, axis=-1, keepdims=True)
 
 #Define the learning rates and epochs to try
 learning_rates = [0.1, 0.01, 0.001, 0.0001, 0.00001]
 epochs = [50, 100, 200]
 
-#Initialize the best accuracy and the corresponding hyperparameters
-best_accuracy = 0
-best_learning_rate = None
-best_epoch = None
-
-#Perform the grid search
-for learning_rate in learning_rates:
-    for epoch in epochs:
-        # Initialize the weights and biases for the layers
-        np.random.seed(42)
-        weights1 = np.random.rand(64, 32)
-        bias1 = np.zeros((32,))
-        weights2 = np.random.rand(32, 16)
-        bias2 = np.zeros((16,))
-        weights3 = np.random.rand(16, 10)
-        bias3 = np.zeros((10,))
-
-    # Train the network
-    for _ in range(epoch):
-        # Forward pass
-        hidden_layer1 = sigmoid(np.dot(X_train, weights1) + bias1)
-        hidden_layer2 = sigmoid(np.dot(hidden_layer1, weights2) + bias2)
-        output_layer = softmax(np.dot(hidden_layer2, weights3) + bias3)
-
-        # Backward pass
-        output_error_grad = output_layer - np.eye(10)[y_train]
-        hidden_error_grad2 = output_error_grad.dot(weights3.T) * hidden_layer2 * (1 - hidden_layer2)
-        hidden_error_grad1 = hidden_error_grad2.dot(weights2.T) * hidden_layer1 * (1 - hidden_layer1)
-
-        # Weight updates
-        weights3 -= learning_rate * hidden_layer2.T.dot(output_error_grad)
-        bias3 -= learning_rate * output_error_grad.mean(axis=0)
-        weights2 -= learning_rate * hidden_layer1.T.dot(hidden_error_grad2)
-        bias2 -= learning_rate * hidden_error_grad2.mean(axis=0)
-        weights1 -= learning_rate * X_train.T.dot(hidden_error_grad1)
-        bias1 -= learning_rate * hidden_error_grad1.mean(axis=0)
-
-    # Evaluate the network on the validation set
-    hidden_layer1 = sigmoid(np.dot(X_val, weights1) + bias1)
-    hidden_layer2 = sigmoid(np.dot(hidden_layer1, weights2) + bias2)
-    output_layer = softmax(np.dot(hidden_layer2, weights3) + bias3)
-    predictions = np.argmax(output_layer, axis=1)
-    accuracy = accuracy_score(y_val, predictions)
-
-    # Update the best accuracy and the corresponding hyperparameters
-    if accuracy > best_accuracy:
-        best_accuracy = accuracy
-        best_learning_rate = learning_rate
-        best_epoch = epoch
-#Print the best accuracy and the corresponding hyperparameters
-print("Best accuracy:", best_accuracy)
-print("Best learning rate:", best_learning_rate)
-print("Best epoch:", best_epoch)
-
-int randomLevel() {
-    int level = 1;
-    while ((rand() % (1 << level)) == 0 && level < MAX_LEVEL) {
-        level++;
-    }
-    return level;
-}
+def evaluate(weights1, bias1, weights2, bias2, weights3, bias3):
+    hidden_layer1 = sigmoid(np.dot(X_val, weights1) + bias1)
+    hidden_layer2 = sigmoid(np.dot(hidden_layer1, weights2) + bias2)
+    output_layer = softmax(np.dot(hidden_layer2, weights3) + bias3)
+    predictions = np.argmax(output_layer, axis=1)
+    return accuracy_score(y_val, predictions)
+
+def train(learning_rate, snapshots=epochs):
+    # One run per learning rate, evaluated at every epoch count in snapshots
+    # Initialize the weights and biases for the layers
+    np.random.seed(42)
+    weights1 = np.random.rand(64, 32)
+    bias1 = np.zeros((32,))
+    weights2 = np.random.rand(32, 16)
+    bias2 = np.zeros((16,))
+    weights3 = np.random.rand(16, 10)
+    bias3 = np.zeros((10,))
+    targets = np.eye(10)[y_train]
+
+    results = []
+    for epoch in range(1, max(snapshots) + 1):
+        # Forward pass
+        hidden_layer1 = sigmoid(np.dot(X_train, weights1) + bias1)
+        hidden_layer2 = sigmoid(np.dot(hidden_layer1, weights2) + bias2)
+        output_layer = softmax(np.dot(hidden_layer2, weights3) + bias3)
+
+        # Backward pass
+        output_error_grad = output_layer - targets
+        hidden_error_grad2 = output_error_grad.dot(weights3.T) * hidden_layer2 * (1 - hidden_layer2)
+        hidden_error_grad1 = hidden_error_grad2.dot(weights2.T) * hidden_layer1 * (1 - hidden_layer1)
+
+        # Weight updates
+        weights3 -= learning_rate * hidden_layer2.T.dot(output_error_grad)
+        bias3 -= learning_rate * output_error_grad.mean(axis=0)
+        weights2 -= learning_rate * hidden_layer1.T.dot(hidden_error_grad2)
+        bias2 -= learning_rate * hidden_error_grad2.mean(axis=0)
+        weights1 -= learning_rate * X_train.T.dot(hidden_error_grad1)
+        bias1 -= learning_rate * hidden_error_grad1.mean(axis=0)
+
+        if epoch in snapshots:
+            results.append((learning_rate, epoch, evaluate(weights1, bias1, weights2, bias2, weights3, bias3)))
+
+    return results
+
+def train_stacked(learning_rates, snapshots=epochs, seeds=None):
+    # K models trained at once: every weight array gets a leading model axis and the products become batched matmuls
+    seeds = [42] * len(learning_rates) if seeds is None else seeds
+    initial = []
+    for seed in seeds:
+        np.random.seed(seed)
+        initial.append((np.random.rand(64, 32), np.random.rand(32, 16), np.random.rand(16, 10)))
+    weights1, weights2, weights3 = (np.stack(layer) for layer in zip(*initial))
+    bias1 = np.zeros((len(seeds), 1, 32))
+    bias2 = np.zeros((len(seeds), 1, 16))
+    bias3 = np.zeros((len(seeds), 1, 10))
+    rates = np.asarray(learning_rates, dtype=np.float64)[:, None, None]
+    targets = np.eye(10)[y_train]
+
+    results = []
+    for epoch in range(1, max(snapshots) + 1):
+        # Forward pass, (K, samples, units)
+        hidden_layer1 = np.matmul(X_train, weights1)
+        hidden_layer1 += bias1
+        sigmoid_inplace(hidden_layer1)
+        hidden_layer2 = np.matmul(hidden_layer1, weights2)
+        hidden_layer2 += bias2
+        sigmoid_inplace(hidden_layer2)
+        output_layer = softmax(np.matmul(hidden_layer2, weights3) + bias3)
+
+        # Backward pass, the activations are overwritten with their derivatives once the weight gradients have them
+        output_error_grad = output_layer
+        output_error_grad -= targets
+        hidden_error_grad2 = np.matmul(output_error_grad, weights3.transpose(0, 2, 1))
+        weights3_grad = np.matmul(hidden_layer2.transpose(0, 2, 1), output_error_grad)
+        hidden_error_grad2 *= hidden_layer2
+        np.subtract(1, hidden_layer2, out=hidden_layer2)
+        hidden_error_grad2 *= hidden_layer2
+        hidden_error_grad1 = np.matmul(hidden_error_grad2, weights2.transpose(0, 2, 1))
+        weights2_grad = np.matmul(hidden_layer1.transpose(0, 2, 1), hidden_error_grad2)
+        hidden_error_grad1 *= hidden_layer1
+        np.subtract(1, hidden_layer1, out=hidden_layer1)
+        hidden_error_grad1 *= hidden_layer1
+
+        # Weight updates
+        weights3_grad *= rates
+        weights3 -= weights3_grad
+        bias3 -= rates * output_error_grad.mean(axis=1, keepdims=True)
+        weights2_grad *= rates
+        weights2 -= weights2_grad
+        bias2 -= rates * hidden_error_grad2.mean(axis=1, keepdims=True)
+        weights1_grad = np.matmul(X_train.T, hidden_error_grad1)
+        weights1_grad *= rates
+        weights1 -= weights1_grad
+        bias1 -= rates * hidden_error_grad1.mean(axis=1, keepdims=True)
+
+        if epoch in snapshots:
+            hidden_layer1 = sigmoid(np.matmul(X_val, weights1) + bias1)
+            hidden_layer2 = sigmoid(np.matmul(hidden_layer1, weights2) + bias2)
+            predictions = np.argmax(np.matmul(hidden_layer2, weights3) + bias3, axis=-1)
+            accuracies = np.mean(predictions == y_val, axis=1)
+            results.extend((learning_rate, epoch, accuracy) for learning_rate, accuracy in zip(learning_rates, accuracies))
+
+    return results
+
+def grid_search(learning_rates, epochs, processes=None, stacked=False):
+    #Perform the grid search, streaming each run into the table as it finishes
+    rows = []
+    print("{:>14} {:>7} {:>9}".format("Learning rate", "Epochs", "Accuracy"))
+    if stacked:
+        runs = [train_stacked(learning_rates, epochs)]
+    else:
+        pool = Pool(processes=processes or min(len(learning_rates), cpu_count()))
+        runs = pool.imap_unordered(partial(train, snapshots=epochs), learning_rates)
+    try:
+        for results in runs:
+            for learning_rate, epoch, accuracy in results:
+                print("{:>14g} {:>7d} {:>9.4f}".format(learning_rate, epoch, accuracy), flush=True)
+                rows.append((learning_rate, epoch, accuracy))
+    finally:
+        if not stacked:
+            pool.close()
+            pool.join()
+
+    #Find the best accuracy and the corresponding hyperparameters, preferring the earliest in grid order on ties
+    rows.sort(key=lambda row: (learning_rates.index(row[0]), epochs.index(row[1])))
+    best_learning_rate, best_epoch, best_accuracy = max(rows, key=lambda row: row[2])
+    return best_accuracy, best_learning_rate, best_epoch
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Grid search the learning rate and epoch count.')
+    parser.add_argument('--stacked', action='store_true', help='Train every learning rate at once as one stacked model')
+    args = parser.parse_args()
+
+    best_accuracy, best_learning_rate, best_epoch = grid_search(learning_rates, epochs, stacked=args.stacked)
+
+    #Print the best accuracy and the corresponding hyperparameters
+    print("Best accuracy:", best_accuracy)
+    print("Best learning rate:", best_learning_rate)
+    print("Best epoch:", best_epoch)